@@ -0,0 +1,222 @@
+# # Benchmark: end-to-end pipeline on synthetic cohorts
+#
+# Generates a synthetic data tree (see synth_data.py) for each cohort size, runs lsa_v4 and the report
+# builder on it and records the wall time and peak RSS of each stage. Every size runs in a fresh
+# process so that peak memory is not carried over between sizes. Results are written as JSON, and
+# --compare prints the change against an earlier results file.
+#
+# Usage: python benchmarks/bench_pipeline.py [--sizes 100 1000 10000] [--batch-size N] [--output results.json] [--compare old.json]
+
+# %%
+import argparse
+import datetime
+import functools
+import json
+import os
+import os.path
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+import psutil
+
+REPO = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, REPO)
+
+
+class RSSMonitor:
+    ''' Background thread sampling this process' RSS, tracking the peak of every open window '''
+
+    def __init__(self, interval: float = 0.005):
+        self.interval = interval
+        self.process = psutil.Process()
+        self.windows = []
+        self.lock = threading.Lock()
+        threading.Thread(target=self._sample, daemon=True).start()
+
+    def _sample(self):
+        while True:
+            rss = self.process.memory_info().rss
+            with self.lock:
+                for window in self.windows:
+                    window['peak'] = max(window['peak'], rss)
+            time.sleep(self.interval)
+
+    def open(self) -> dict:
+        window = {'peak': self.process.memory_info().rss}
+        with self.lock:
+            self.windows.append(window)
+        return window
+
+    def close(self, window: dict) -> int:
+        with self.lock:
+            self.windows = [x for x in self.windows if x is not window]
+        return max(window['peak'], self.process.memory_info().rss)
+
+
+def instrument(module, name: str, stage: str, stages: dict, monitor: RSSMonitor):
+    ''' Replace module.name with a wrapper that accumulates its wall time and peak RSS under stage '''
+    fn = getattr(module, name)
+
+    @functools.wraps(fn)
+    def wrapper(*args, **kwargs):
+        window = monitor.open()
+        t1 = time.perf_counter()
+        try:
+            return fn(*args, **kwargs)
+        finally:
+            record = stages.setdefault(stage, {'seconds': 0.0, 'peak_rss_mb': 0.0, 'calls': 0})
+            record['seconds'] += time.perf_counter() - t1
+            record['peak_rss_mb'] = max(record['peak_rss_mb'], monitor.close(window) / 2**20)
+            record['calls'] += 1
+
+    setattr(module, name, wrapper)
+
+
+def bench_size(n_students: int, args: argparse.Namespace) -> dict:
+    ''' Run every stage once on a synthetic cohort of n_students, in this process '''
+    import lsa_v4
+    import lsoutput
+    import lsgrade
+    import make_ls_report_v2
+    import synth_data
+
+    os.chdir(REPO)  # the report builder reads its templates relative to the working directory
+    monitor = RSSMonitor()
+    stages = {}
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        data_path, output_path = f'{tmpdir}/Data', f'{tmpdir}/Output'
+        os.makedirs(output_path)
+
+        t1 = time.perf_counter()
+        synth_data.generate(data_path, n_students, seed=args.seed)
+        generate_seconds = time.perf_counter() - t1
+
+        instrument(lsa_v4, 'load_files', 'load_data.parse', stages, monitor)
+        instrument(lsa_v4, 'load_data', 'load_data', stages, monitor)
+        instrument(lsgrade, 'grade_incremental', 'run.grade', stages, monitor)
+        instrument(lsa_v4, 'run_batched', 'run.grade', stages, monitor)
+        instrument(lsa_v4, 'run', 'run', stages, monitor)
+        instrument(make_ls_report_v2, 'run', 'report', stages, monitor)
+
+        ns = argparse.Namespace(data_path=data_path, output_path=output_path, course_prefix=['mat188-2023f'],
+                                debug=False, compute_exams=True, generate_reports=False,
+                                shards=max(1, args.workers or 1), per_student=False, incremental=False,
+                                no_cache=True, cache_dir=None, workers=args.workers, chunksize=None,
+                                batch_size=args.batch_size, output_format='csv', dump_scores=False, db=None,
+                                watch=False, no_format=False)
+        with open(os.devnull, 'w') as devnull:
+            stdout, sys.stdout = sys.stdout, devnull
+            try:
+                lsa_v4.run(ns)
+
+                if shutil.which('pdflatex'):
+                    make_ls_report_v2.run(ns)
+                else:
+                    # no LaTeX here, so only time building the report source
+                    student_progress = lsoutput.read_achieved(output_path)
+                    student_progress[('student', 'student_id')] = student_progress.index
+                    template = make_ls_report_v2.compile_template('./tex_files/ls_report_page.tex')
+
+                    window = monitor.open()
+                    t1 = time.perf_counter()
+                    with open(f'{output_path}/combined.tex', 'w') as f:
+                        for page in make_ls_report_v2.build_pages(student_progress, template):
+                            f.write(page)
+                    stages['report.pages'] = {'seconds': time.perf_counter() - t1,
+                                              'peak_rss_mb': monitor.close(window) / 2**20,
+                                              'calls': 1}
+            finally:
+                sys.stdout = stdout
+
+    return {
+        'students': n_students,
+        'generate_seconds': generate_seconds,
+        'stages': stages,
+        'peak_rss_mb': max(x['peak_rss_mb'] for x in stages.values()),
+    }
+
+
+def git_revision() -> str:
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=REPO, capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return 'unknown'
+
+
+def compare(old: dict, new: dict):
+    ''' Print the ratio of new to old time and peak memory for every stage measured in both '''
+    old_sizes = {x['students']: x for x in old['results']}
+    for result in new['results']:
+        prev = old_sizes.get(result['students'])
+        if prev is None:
+            continue
+
+        print(f'{result["students"]} students, {old["revision"]} -> {new["revision"]}')
+        for stage, record in result['stages'].items():
+            if stage in prev['stages']:
+                was = prev['stages'][stage]
+                print(f'  {stage:20s} time {record["seconds"] / max(was["seconds"], 1e-9):6.2f}x'
+                      f'   peak RSS {record["peak_rss_mb"] / max(was["peak_rss_mb"], 1e-9):6.2f}x')
+
+
+def run(args: argparse.Namespace):
+    if args.single is not None:
+        print(json.dumps(bench_size(args.single, args)))
+        return
+
+    results = []
+    for n_students in args.sizes:
+        cmd = [sys.executable, os.path.abspath(__file__), '--single', str(n_students), '--seed', str(args.seed)]
+        if args.workers is not None:
+            cmd += ['--workers', str(args.workers)]
+        if args.batch_size is not None:
+            cmd += ['--batch-size', str(args.batch_size)]
+        out = subprocess.run(cmd, capture_output=True, text=True)
+        if out.returncode != 0:
+            sys.exit(f'Benchmark failed for {n_students} students:\n{out.stderr}')
+
+        result = json.loads(out.stdout.strip().splitlines()[-1])
+        results.append(result)
+
+        print(f'{n_students} students')
+        for stage, record in result['stages'].items():
+            print(f'  {stage:20s} {record["seconds"]:8.2f} s   peak RSS {record["peak_rss_mb"]:8.1f} MB')
+
+    report = {
+        'revision': git_revision(),
+        'date': datetime.datetime.now().isoformat(timespec='seconds'),
+        'python': platform.python_version(),
+        'cpu_count': os.cpu_count(),
+        'results': results,
+    }
+
+    output = args.output or os.path.join(REPO, 'benchmarks', 'results', f'pipeline_{report["revision"]}.json')
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, 'w') as f:
+        json.dump(report, f, indent=2)
+    print(f'Wrote {output}')
+
+    if args.compare:
+        with open(args.compare, 'r') as f:
+            compare(json.load(f), report)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark the grading pipeline on synthetic cohorts.')
+    parser.add_argument('--sizes', type=int, nargs='+', default=[100, 1000, 10000], help='Cohort sizes to benchmark.')
+    parser.add_argument('--workers', type=int, default=None, help='Passed to lsa_v4 --workers.')
+    parser.add_argument('--batch-size', type=int, default=None, help='Passed to lsa_v4 --batch-size.')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', default=None, help='Results file, defaults to benchmarks/results/pipeline_<revision>.json.')
+    parser.add_argument('--compare', default=None, help='Earlier results file to compare against.')
+    parser.add_argument('--single', type=int, default=None, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    run(args)
@@ -0,0 +1,119 @@
+# # Benchmark: command line startup time
+#
+# Runs `python -X importtime -m lscli ...` for commands that should respond instantly and checks
+# that the modules they import stay within a time budget and do not include the heavy dependencies
+# (pandas, numpy, bs4, tqdm, psutil), which are only imported by the stages that need them.
+#
+# Besides --help, the small operational commands are run on a synthetic data tree (see synth_data.py):
+# `check-table` is held to the same import budget, and `parse`, which builds a pandas DataFrame of
+# the export, to a separate wall time budget.
+#
+# Usage: python benchmarks/bench_startup.py [--budget-ms 50] [--parse-budget-ms 1500] [--repeat 5]
+
+# %%
+import argparse
+import os
+import os.path
+import re
+import subprocess
+import sys
+import tempfile
+import time
+
+REPO = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+
+COMMANDS = [
+    ['--help'],
+    ['grade', '--help'],
+    ['report', '--help'],
+    ['sweep', '--help'],
+    ['query', '--help'],
+    ['parse', '--help'],
+    ['check-table', '--help'],
+    ['check-table', '{data}/standards_lookup_table.xlsx'],
+]
+
+# commands that load their inputs into pandas, held to --parse-budget-ms of wall time instead
+WORK_COMMANDS = [
+    ['parse', '{data}/mat188-2023f-ww1.html', '--output', os.devnull],
+]
+
+HEAVY = ['pandas', 'numpy', 'bs4', 'tqdm', 'psutil', 'pyarrow', 'openpyxl']
+
+IMPORTTIME_RE = re.compile(r'^import time:\s+(\d+) \|\s+(\d+) \|( *)(\S+)$')
+
+
+def import_times(argv: list) -> dict:
+    '''
+    Run lscli with -X importtime and collect the top-level imports it triggered.
+
+    Modules imported by the interpreter itself before lscli (e.g. encodings, site) are counted too, but
+    they are the same for every command.
+
+    :param argv: lscli arguments
+    :return: {module: cumulative microseconds} for the outermost imports, all imported module names under None, and the wall time in seconds under 'wall'
+    '''
+    t1 = time.perf_counter()
+    out = subprocess.run([sys.executable, '-X', 'importtime', '-m', 'lscli'] + argv, cwd=REPO,
+                         capture_output=True, text=True)
+    wall = time.perf_counter() - t1
+    if out.returncode != 0:
+        raise RuntimeError(f'lscli {" ".join(argv)} failed:\n{out.stderr}')
+
+    times, modules = {'wall': wall}, set()
+    for line in out.stderr.splitlines():
+        m = IMPORTTIME_RE.match(line)
+        if m is None:
+            continue
+        modules.add(m.group(4).split('.')[0])
+        if len(m.group(3)) == 1:
+            times[m.group(4)] = int(m.group(2))
+
+    times[None] = modules
+    return times
+
+
+def run(args: argparse.Namespace) -> bool:
+    import synth_data
+
+    ok = True
+    with tempfile.TemporaryDirectory() as data:
+        synth_data.generate(data, n_students=60, n_sets=1, n_weeks=2, n_standards=10)
+
+        for argv, work in [(x, False) for x in COMMANDS] + [(x, True) for x in WORK_COMMANDS]:
+            argv = [x.format(data=data) for x in argv]
+            name = 'lscli ' + ' '.join(os.path.basename(x) for x in argv)
+
+            # best of several runs, to leave out disk cache misses and noisy neighbours
+            runs = [import_times(argv) for _ in range(args.repeat)]
+            total_ms = min(sum(v for k, v in x.items() if k not in (None, 'wall')) for x in runs) / 1e3
+            wall_ms = min(x['wall'] for x in runs) * 1e3
+            heavy = sorted(set(HEAVY) & runs[0][None])
+
+            if work:
+                status = 'ok' if wall_ms <= args.parse_budget_ms else 'FAIL'
+                print(f'{name:52s} {wall_ms:8.1f} ms wall    (budget {args.parse_budget_ms:g} ms)  {status}')
+            else:
+                status = 'ok' if total_ms <= args.budget_ms and not heavy else 'FAIL'
+                print(f'{name:52s} {total_ms:8.1f} ms import  (budget {args.budget_ms:g} ms)  {status}')
+                if heavy:
+                    print(f'  imports {", ".join(heavy)}')
+            ok = ok and status == 'ok'
+
+            if args.verbose:
+                slowest = sorted(((v, k) for k, v in runs[0].items() if k not in (None, 'wall')), reverse=True)[:10]
+                for us, module in slowest:
+                    print(f'    {us / 1e3:8.1f} ms  {module}')
+
+    return ok
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Check that lscli starts within a time budget.')
+    parser.add_argument('--budget-ms', type=float, default=50, help='Maximum total import time per command.')
+    parser.add_argument('--parse-budget-ms', type=float, default=1500, help='Maximum wall time of parsing one WeBWorK export, including interpreter startup.')
+    parser.add_argument('--repeat', type=int, default=5, help='Number of runs per command, the fastest is used.')
+    parser.add_argument('--verbose', action='store_true', help='List the slowest imports of each command.')
+    args = parser.parse_args()
+
+    sys.exit(0 if run(args) else 1)
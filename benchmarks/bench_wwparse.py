@@ -0,0 +1,102 @@
+# # Benchmark: WeBWorK progress table stacking
+#
+# Compares the vectorized wwparse.stack_problems against the original per-problem concat and
+# row-wise score_key construction on a synthetic 1500 student x 40 problem set.
+#
+# Usage: python benchmarks/bench_wwparse.py [--students 1500] [--problems 40]
+
+# %%
+import argparse
+import os.path
+import re
+import sys
+import tempfile
+import timeit
+
+import numpy as np
+import pandas as pd
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import wwparse
+
+
+def make_progress_html(n_students: int, n_problems: int, seed: int = 0) -> str:
+    ''' Build a WeBWorK student progress export in the format expected by wwparse.parse_html '''
+    rng = np.random.default_rng(seed)
+
+    header = ('<tr><td>Name</td><td>Score</td><td>Out Of</td><td>Problems<br>' +
+              ' '.join(str(p + 1) for p in range(n_problems)) + '</td><td>Login Name</td></tr>')
+    rows = []
+    for si in range(n_students):
+        scores = ' '.join(rng.choice(['100', '50', '0', '.'], n_problems))
+        n_incor = ' '.join(str(x) for x in rng.integers(0, 5, n_problems))
+        rows.append(f'<tr><td>Student {si}</td><td>{si % n_problems}</td><td>{n_problems}</td>'
+                    f'<td><pre>{scores}\n{n_incor}</pre></td><td>stu{si:05d}</td></tr>')
+
+    return '<html><body><table>' + header + '\n'.join(rows) + '</table></body></html>'
+
+
+def legacy_stack(df: pd.DataFrame, set_id: str) -> pd.DataFrame:
+    ''' The original stacked=True branch of wwparse.parse_html, for reference '''
+    problems = list(
+        set([
+            int(re.match(r'problem(\d+)+_', col).group(1))
+            for col in df.columns if 'problem' in col
+        ]))
+
+    all_data = []
+
+    for prob in problems:
+        col_names = [x for x in df.columns if f'problem{prob}_' in x]
+        col_names.insert(0, 'login_name')
+
+        col_names_clean = [x.replace(f'problem{prob}_', '') for x in col_names]
+
+        sub_df = df[col_names].copy()
+        sub_df.columns = col_names_clean
+
+        sub_df['problem_num'] = prob
+        all_data.append(sub_df)
+
+    final_df = pd.concat(all_data).reset_index(drop=True)
+    final_df['set_id'] = set_id
+    final_df['score_key'] = final_df.apply(
+        lambda r: f'{r["set_id"]}-{r["problem_num"]:.0f}', axis=1)
+
+    return final_df
+
+
+def run(args: argparse.Namespace):
+    with tempfile.TemporaryDirectory() as tmpdir:
+        filename = os.path.join(tmpdir, 'mat188-2023f-ww1.html')
+        with open(filename, 'w', encoding='utf-8') as f:
+            f.write(make_progress_html(args.students, args.problems))
+
+        wide = wwparse.parse_html(filename, save_csv=False, stacked=False, engine='stream')
+
+    # both implementations must produce the same table
+    expected = legacy_stack(wide, 'ww1')
+    actual = wwparse.stack_problems(wide, 'ww1')
+    pd.testing.assert_frame_equal(expected, actual.astype({'set_id': object}))
+
+    t_legacy = min(timeit.repeat(lambda: legacy_stack(wide, 'ww1'), number=1, repeat=args.repeat))
+    t_vector = min(timeit.repeat(lambda: wwparse.stack_problems(wide, 'ww1'), number=1, repeat=args.repeat))
+
+    print(f'{args.students} students x {args.problems} problems ({len(actual)} rows)')
+    print(f'  legacy stacking:     {t_legacy * 1000:8.1f} ms')
+    print(f'  vectorized stacking: {t_vector * 1000:8.1f} ms')
+    print(f'  speedup:             {t_legacy / t_vector:8.1f}x')
+
+    if t_legacy / t_vector < args.min_speedup:
+        sys.exit(f'Speedup below the required {args.min_speedup}x')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark stacking of WeBWorK progress tables.')
+    parser.add_argument('--students', type=int, default=1500)
+    parser.add_argument('--problems', type=int, default=40)
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--min-speedup', type=float, default=10)
+    args = parser.parse_args()
+
+    run(args)
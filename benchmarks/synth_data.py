@@ -0,0 +1,168 @@
+# # Synthetic cohort generator
+#
+# Writes a ../Data-style tree with the same layout and file formats as the real course exports,
+# so that the pipeline can be run and benchmarked without student data.
+#
+# Usage: python benchmarks/synth_data.py <output dir> [--students 1000] [--sets 10] [--standards 60]
+
+# %%
+import argparse
+import os
+import os.path
+
+import numpy as np
+import pandas as pd
+
+DAYS = ['Mon', 'Tue', 'Wed', 'Thu', 'Fri']
+
+
+def write_progress_html(filename: str, logins: list, n_problems: int, rng: np.random.Generator):
+    ''' Write a WeBWorK student progress export in the format expected by wwparse.parse_html '''
+    header = ('<tr><td>Name</td><td>Score</td><td>Out Of</td><td>Problems<br>' +
+              ' '.join(str(p + 1) for p in range(n_problems)) + '</td><td>Login Name</td></tr>')
+
+    # most attempted problems are eventually solved, some are never opened
+    scores = rng.choice(['100', '100', '100', '50', '0', '.'], (len(logins), n_problems))
+    n_incor = rng.geometric(0.5, (len(logins), n_problems)) - 1
+
+    with open(filename, 'w', encoding='utf-8') as f:
+        f.write('<html><body><table>' + header)
+        for si, login in enumerate(logins):
+            total = sum(float(x) / 100 for x in scores[si] if x != '.')
+            f.write(f'\n<tr><td>{login}</td><td>{total:.1f}</td><td>{n_problems}</td>'
+                    f'<td><pre>{" ".join(scores[si])}\n{" ".join(map(str, n_incor[si]))}</pre></td>'
+                    f'<td>{login}</td></tr>')
+        f.write('</table></body></html>')
+
+
+def generate(root: str,
+             n_students: int = 1000,
+             n_sets: int = 10,
+             n_problems: int = 12,
+             n_weeks: int = 10,
+             n_sections: int = 0,
+             n_standards: int = 60,
+             seed: int = 0):
+    '''
+    Write a synthetic course data tree.
+
+    :param root: directory to write to, e.g. '../Data'
+    :param n_students: number of enrolled students
+    :param n_sets: number of WeBWorK sets
+    :param n_problems: number of problems per WeBWorK set
+    :param n_weeks: number of tutorial weeks, each with two SBGs assigned to different tutorial days
+    :param n_sections: number of tutorial sections, defaults to one per 30 students
+    :param n_standards: number of learning standards in the grading sheet
+    :param seed: random seed
+    '''
+    rng = np.random.default_rng(seed)
+    n_sections = n_sections or max(1, n_students // 30)
+    os.makedirs(root, exist_ok=True)
+
+    # roster and gradebook, with a few students who have since dropped the course
+    logins = [f'stu{i:05d}' for i in range(n_students)]
+    emails = [f'{x}@mail.utoronto.ca' for x in logins]
+    sections = 101 + np.arange(n_students) % n_sections
+    pd.DataFrame({
+        'Student Number': 1000000000 + np.arange(n_students),
+        'First Name': [f'First{i}' for i in range(n_students)],
+        'Last Name': [f'Last{i}' for i in range(n_students)],
+        'UTORid': logins,
+        'Email': emails,
+    }).to_csv(f'{root}/mat188-2023f-roster.csv', index=False)
+
+    enrolled = rng.random(n_students) > 0.02
+    pd.DataFrame({
+        'SIS User ID': [x for x, e in zip(logins, enrolled) if e] + [np.nan],
+        'Section': [f'LEC0101 and TUT{x:04d}' for x, e in zip(sections, enrolled) if e] + ['Points Possible'],
+    }).to_csv(f'{root}/mat188-2023f-gradebook.csv', index=False)
+
+    # WeBWorK sets, including instructor and TA accounts that are not on the roster
+    staff = ['instructor1', 'ta_alice', 'ta_bob']
+    for s in range(1, n_sets + 1):
+        write_progress_html(f'{root}/mat188-2023f-ww{s}.html', logins + staff, n_problems, rng)
+
+    # tutorials: each tutorial day is assigned one of the week's two SBGs
+    section_day = {sec: DAYS[i % len(DAYS)] for i, sec in enumerate(range(101, 101 + n_sections))}
+    sbg_assigned = pd.DataFrame({w: rng.integers(1, 3, len(DAYS)) for w in range(1, n_weeks + 1)}, index=DAYS)
+    tut_parts = {(w, sbg): [f'tut{w}-{sbg}-{p}' for p in 'abc'[:rng.integers(1, 4)]]
+                 for w in range(1, n_weeks + 1) for sbg in (1, 2)}
+
+    for sec in range(101, 101 + n_sections):
+        tut_dir = f'{root}/Tutorials-Processed/TUT{sec:04d}'
+        os.makedirs(tut_dir, exist_ok=True)
+        members = np.flatnonzero(sections == sec)
+
+        for w in range(1, n_weeks + 1):
+            sbg = sbg_assigned.loc[section_day[sec], w]
+            sheet = pd.DataFrame({
+                'First Name': [f'First{i}' for i in members],
+                'Last Name': [f'Last{i}' for i in members],
+                'Email': [emails[i] for i in members],
+                'Attendance': rng.integers(0, 2, len(members)),
+            })
+            for key in tut_parts[(w, sbg)]:
+                sheet[f'SBG {sbg} part {key[-1]} | {key}'] = rng.choice([0, 1, np.nan], len(members), p=[.25, .65, .1])
+
+            # sum row at the bottom, as exported by the TAs' spreadsheets
+            sheet.loc[len(sheet)] = [np.nan, np.nan, np.nan] + list(sheet.iloc[:, 3:].sum())
+            sheet.to_excel(f'{tut_dir}/Week{w:02d}_SBG.xlsx', index=False)
+
+    tut_dates = pd.DataFrame({'tutorial': list(section_day), 'day': list(section_day.values())})
+
+    # midterm Gradescope export with a points-possible row
+    mt_dir = f'{root}/Midterm1'
+    os.makedirs(mt_dir, exist_ok=True)
+    mt_qs = [f'mt1-{q}' for q in range(1, 7)]
+    midterm = pd.DataFrame({'SID': np.append(1000000000 + np.arange(n_students), np.nan).astype(object),
+                            'Email': emails + [np.nan]})
+    for q in mt_qs:
+        midterm[f'Q{q[4:]}|{q}'] = list(rng.choice(['TRUE', 'FALSE'], n_students, p=[.7, .3])) + [np.nan]
+    midterm.to_csv(f'{mt_dir}/Midterm1_scores.csv', index=False)
+
+    # manual score overrides
+    n_manual = max(10, n_students // 20)
+    pd.DataFrame({
+        'login_name': rng.choice(logins, n_manual),
+        'score_key': rng.choice(['oral-1', 'oral-2', 'ww1-1'], n_manual),
+        'correct': rng.choice([0, 1], n_manual),
+    }).to_excel(f'{root}/mat188-2023f-manualscores.xlsx', index=False)
+
+    # learning standards lookup table
+    ww_qs = [f'ww{s}-{p}' for s in range(1, n_sets + 1) for p in range(1, n_problems + 1)]
+    tut_qs = [q for parts in tut_parts.values() for q in parts]
+    grading = []
+    for k in range(n_standards):
+        row = {'standard': f'LS{k + 1:03d}'}
+
+        qs = list(rng.choice(ww_qs, rng.integers(1, 5), replace=False))
+        row['webwork'] = (f'{rng.integers(1, len(qs) + 1)}|' if len(qs) > 1 and rng.random() < .6 else '') + ','.join(qs)
+
+        if rng.random() < .8:
+            qs = list(rng.choice(tut_qs, rng.integers(1, 3), replace=False))
+            row['tutorial'] = ('1|' if len(qs) > 1 and rng.random() < .5 else '') + ','.join(qs)
+
+        if rng.random() < .5:
+            row['exam'] = ','.join(rng.choice(mt_qs + ['oral-1', 'oral-2'], rng.integers(1, 3), replace=False))
+
+        grading.append(row)
+
+    with pd.ExcelWriter(f'{root}/standards_lookup_table.xlsx') as writer:
+        pd.DataFrame(grading).to_excel(writer, sheet_name='grading', index=False)
+        tut_dates.to_excel(writer, sheet_name='tut_dates', index=False)
+        sbg_assigned.to_excel(writer, sheet_name='sbg_assigned')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Write a synthetic course data tree for testing and benchmarking.')
+    parser.add_argument('root', help='Directory to write the data tree to.')
+    parser.add_argument('--students', type=int, default=1000)
+    parser.add_argument('--sets', type=int, default=10)
+    parser.add_argument('--problems', type=int, default=12)
+    parser.add_argument('--weeks', type=int, default=10)
+    parser.add_argument('--sections', type=int, default=0, help='Number of tutorial sections, defaults to one per 30 students.')
+    parser.add_argument('--standards', type=int, default=60)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    generate(args.root, args.students, args.sets, args.problems, args.weeks, args.sections, args.standards, args.seed)
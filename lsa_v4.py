@@ -4,20 +4,68 @@
 # MAT188 2023F at the University of Toronto
 
 # %%
+from typing import Optional
+
 import pandas as pd
 import numpy as np
 import glob
-from itertools import compress
 import wwparse
-from tqdm import tqdm
+import xlsxparse
+import lsgrade
+import lscache
+import lscli
+import lscube
+import lsdb
+import lsoutput
+import lsprofile
+import scorestore
 import re
 import argparse
 import multiprocessing as mp
 import functools
 import os, os.path
+import sys
+import time
+import datetime
+import traceback
 
 nthreads = mp.cpu_count() - 1
 
+
+def n_workers(args: argparse.Namespace) -> int:
+    ''' Number of worker processes, from --workers or one less than the number of CPUs '''
+    return nthreads if args.workers is None else args.workers
+
+
+def course_files(args: argparse.Namespace, suffix: str) -> list:
+    ''' {data_path}/{prefix}-{suffix} for every course prefix, e.g. the roster of each course '''
+    return [f'{args.data_path}/{x}-{suffix}' for x in args.course_prefix]
+
+
+def read_course_csv(args: argparse.Namespace, suffix: str, key: str) -> pd.DataFrame:
+    '''
+    Concatenate a per-course CSV file over the course prefixes.
+
+    Students listed under more than one prefix (e.g. students retaking the course) keep only their row
+    from the last prefix given, so that each has one roster entry and one tutorial section. Their
+    scores from every prefix are still graded together.
+
+    :param args: command line arguments
+    :param suffix: file name after the course prefix, e.g. 'roster.csv'
+    :param key: column identifying the student, e.g. 'UTORid'; rows without one are kept as they are
+    :return: DataFrame
+    '''
+    df = pd.concat([pd.read_csv(x) for x in course_files(args, suffix)], ignore_index=True)
+
+    repeated = df[key].notna() & df[key].duplicated(keep='last')
+    if repeated.any():
+        logins = sorted(map(str, df.loc[repeated, key].unique()))
+        print(f'{len(logins)} students listed more than once in {suffix}, keeping their row from the last course prefix: '
+              + ', '.join(logins[:10]) + (', ...' if len(logins) > 10 else ''))
+
+    return df[~repeated]
+
+
 def extract_tutorial_number(x: str):
     rel = re.search(r'TUT(\d{4})', x)
 
@@ -27,110 +75,208 @@ def extract_tutorial_number(x: str):
         return int(rel.group(1))
 
 
-def grade_by_ls(args, lsref):
-    this_student, this_student_scores = args
+def load_webwork(filename: str) -> pd.DataFrame:
+    ''' Load one WeBWorK progress export in long format '''
+    print(f'Loading {filename}...')
+    this_score = wwparse.parse_html(filename, save_csv=False, engine='stream')
 
-    this_standards_achieved = pd.Series(index=pd.MultiIndex.from_frame(
-        lsref[['modality', 'standard']].drop_duplicates()),
-                                        name=this_student)
+    # a question is correct if all parts are correct
+    this_score['correct'] = this_score['score'] == 100
 
-    for this_idx, this_standard in lsref.iterrows():
-        question_keys = [x.strip() for x in this_standard['reqs'].split(',')]
+    return this_score
 
-        if '|' in question_keys[0]:
-            n_correct_required = int(question_keys[0].split('|')[0])
-            question_keys[0] = question_keys[0].split('|')[1]
-            ratio_required = n_correct_required / len(question_keys)
-        else:
-            ratio_required = 1
-
-        # get correctness for each question
-        question_isgraded = [
-            ~np.any(this_student_scores.loc[x, 'is_graded'] == False)
-            if x in this_student_scores.index else True for x in question_keys
-        ]
-        question_iscorrect = [
-            np.any(this_student_scores.loc[x, 'correct'])
-            if x in this_student_scores.index else False for x in question_keys
-        ]
-
-        # check if the required number of questions are correct
-        if np.sum(question_isgraded) == 0:
-            ls_cor = np.nan
-        else:
-            corsum = np.nansum(question_iscorrect)
-            ls_cor = int(
-                (corsum >= 1)
-                and (corsum / np.sum(question_isgraded) >= ratio_required))
 
-        # if all requirements are met, set this standard to true
-        this_standards_achieved[tuple(this_standard[['modality',
-                                                     'standard']])] = ls_cor
+def load_tutorial(filename: str, roster: pd.DataFrame) -> pd.DataFrame:
+    ''' Load one tutorial SBG workbook in long format '''
+    print(f'Loading {filename}...')
+    email_login = dict(zip(roster['Email'], roster['UTORid']))
 
-    return this_standards_achieved
+    return xlsxparse.records_frame(xlsxparse.iter_sbg_records(filename, email_login))
 
 
-def load_data(args: argparse.Namespace):
-    #######################################################################
-    ## Data loading
+def load_manual_scores(filename: str) -> pd.DataFrame:
+    ''' Load the manual score overrides in long format '''
+    print(f'Loading {filename}...')
+    return xlsxparse.records_frame(xlsxparse.iter_manual_records(filename), xlsxparse.MANUAL_COLUMNS)
+
+
+def load_midterm(filename: str, roster: pd.DataFrame) -> pd.DataFrame:
+    ''' Load one midterm Gradescope export in long format '''
+    print(f'Loading {filename}...')
+    this_score = pd.read_csv(filename)
+
+    # remove sum rows
+    this_score = this_score[~this_score['SID'].isna()]
+
+    # merge with roster
+    this_score = this_score.merge(roster[['Email', 'UTORid']],
+                                  how='left',
+                                  on='Email')
+    this_score = this_score.rename(columns={'UTORid': 'login_name'})
+
+    # parse score key
+    ls_cols = [x for x in this_score.columns if '|' in x]
+    this_score = this_score[['login_name'] + ls_cols]
+    this_score.columns = ['login_name'
+                          ] + [x.split('|')[1] for x in ls_cols]
+
+    # stack into long format
+    this_score = this_score.melt(id_vars='login_name',
+                                 var_name='score_key',
+                                 value_name='correct')
+
+    # check if correct has type string, convert to int
+    this_score['correct'] = this_score['correct'].map({
+        'TRUE': 1,
+        'FALSE': 0,
+        True: 1,
+        False: 0
+    })
+
+    return this_score
 
-    # import table of learning standards
-    lsref = pd.read_excel(f'{args.data_path}/standards_lookup_table.xlsx',
-                          sheet_name='grading')
+
+def _loader_name(loader) -> str:
+    while isinstance(loader, functools.partial):
+        loader = loader.func
+    return loader.__name__
+
+
+def _call_loader(loader, filename: str):
+    with lsprofile.stage(_loader_name(loader), file=os.path.basename(filename)) as st:
+        df = loader(filename)
+        st['rows'] = len(df)
+
+    return df
+
+
+def _call_loader_traced(loader, filename: str):
+    ''' _call_loader for pool workers, also returning the stages recorded in the worker '''
+    df = _call_loader(loader, filename)
+    return df, lsprofile.drain()
+
+
+def load_files(jobs: list, nworkers: int, cache: Optional[lscache.ParseCache] = None) -> list:
+    '''
+    Run per-file loaders, in a process pool when more than one worker is available.
+
+    :param jobs: list of (loader, filename) pairs, where loader is a picklable callable taking a filename
+    :param nworkers: maximum number of worker processes
+    :param cache: parse cache to reuse results from previous runs, or None to always parse
+    :return: list of loaded DataFrames, in the same order as jobs
+    '''
+    results = [None] * len(jobs)
+    if cache is not None:
+        results = [cache.get(loader, filename) for loader, filename in jobs]
+
+    todo = [ji for ji, x in enumerate(results) if x is None]
+    if nworkers <= 1 or len(todo) <= 1:
+        loaded = [_call_loader(*jobs[ji]) for ji in todo]
+    else:
+        with mp.Pool(min(nworkers, len(todo)), initializer=lsprofile.init_worker, initargs=(lsprofile.config(), )) as p:
+            loaded = p.starmap(_call_loader_traced, [jobs[ji] for ji in todo])
+
+        for _, events in loaded:
+            lsprofile.extend(events)
+        loaded = [df for df, _ in loaded]
+
+    for ji, df in zip(todo, loaded):
+        results[ji] = df
+        if cache is not None:
+            cache.put(*jobs[ji], df)
+
+    if cache is not None:
+        cache.save_index()
+
+    return results
+
+
+def sheet_requirements(lsref: pd.DataFrame, compute_exams: bool) -> lsgrade.RequirementTable:
+    '''
+    Parse a grading sheet of the lookup table.
+
+    :param lsref: grading sheet with a 'standard' column and one column of requirement strings per modality
+    :param compute_exams: whether to keep the exam requirements
+    :return: RequirementTable
+    '''
     lsref = lsref.set_index('standard').stack().reset_index()
     lsref.columns = ['standard', 'modality', 'reqs']
 
     # ignore exams
-    if not args.compute_exams:
+    if not compute_exams:
         lsref = lsref[lsref['modality'] != 'exam']
 
-    # load tutorial SBG assignments
-    tut_day_tbl = pd.read_excel(f'{args.data_path}/standards_lookup_table.xlsx',
-                                sheet_name='tut_dates',
-                                index_col='tutorial')
-    tut_sbg_assigned = pd.read_excel(f'{args.data_path}/standards_lookup_table.xlsx',
-                                     sheet_name='sbg_assigned',
-                                     index_col=0)
+    # parse every requirement string once
+    return lsgrade.parse_requirements(lsref)
+
+
+def load_data(args: argparse.Namespace, cache: Optional[lscache.ParseCache] = None):
+    #######################################################################
+    ## Data loading
+
+    if cache is None and not args.no_cache:
+        cache = lscache.ParseCache(args.cache_dir or f'{args.output_path}/.parse_cache')
+    if cache is not None:
+        cache.hits = cache.misses = 0
+
+    # import table of learning standards and tutorial SBG assignments
+    lookup_table = f'{args.data_path}/standards_lookup_table.xlsx'
+    with lsprofile.stage('load_lookup_table'):
+        lsref, tut_day_tbl, tut_sbg_assigned = load_files([
+            (functools.partial(pd.read_excel, sheet_name='grading'), lookup_table),
+            (functools.partial(pd.read_excel, sheet_name='tut_dates', index_col='tutorial'), lookup_table),
+            (functools.partial(pd.read_excel, sheet_name='sbg_assigned', index_col=0), lookup_table),
+        ], n_workers(args), cache)
+
+    requirements = sheet_requirements(lsref, args.compute_exams)
 
     # load roster
-    roster = pd.read_csv(f'{args.data_path}/mat188-2023f-roster.csv')
-    gradebook = pd.read_csv(f'{args.data_path}/mat188-2023f-gradebook.csv')
-    gradebook = gradebook[~gradebook['SIS User ID'].isna()]
-    gradebook = gradebook[['SIS User ID',
-                           'Section']].set_index(['SIS User ID'])
-    gradebook['tut'] = gradebook['Section'].apply(extract_tutorial_number)
-    gradebook['tut_day'] = gradebook['tut'].apply(
-        lambda x: tut_day_tbl.loc[x, 'day'])
+    with lsprofile.stage('load_roster'):
+        roster = read_course_csv(args, 'roster.csv', 'UTORid')
+        gradebook = read_course_csv(args, 'gradebook.csv', 'SIS User ID')
+        gradebook = gradebook[~gradebook['SIS User ID'].isna()]
+        gradebook = gradebook[['SIS User ID',
+                               'Section']].set_index(['SIS User ID'])
+        gradebook['tut'] = gradebook['Section'].apply(extract_tutorial_number)
+        gradebook['tut_day'] = gradebook['tut'].apply(
+            lambda x: tut_day_tbl.loc[x, 'day'])
 
     roster = roster[roster['UTORid'].isin(
         gradebook.index)]  # drop students who dropped the course
+    roster = roster.assign(tut=gradebook['tut'].reindex(roster['UTORid']).to_numpy(),
+                           tut_day=gradebook['tut_day'].reindex(roster['UTORid']).to_numpy())
 
     if args.debug:
         roster = pd.concat(
             (roster[:20], roster[-20:]
              ))  # DEBUGGING: only keep first and last 20 students for speed
 
-    scores = None
-
-    ##### WEBWORK #####
-    for filename in glob.glob(f'{args.data_path}/*.html'):
-        print(f'Loading {filename}...')
-        this_score = wwparse.parse_html(filename, save_csv=False)
-
-        # a question is correct if all parts are correct
-        this_score['correct'] = this_score['score'] == 100
-
-        scores = pd.concat([scores, this_score], ignore_index=True)
+    # parse every source export at once, sorted so that the score table is built in a fixed order
+    roster_emails = roster[['Email', 'UTORid']]
+    ww_files = sorted(x for prefix in course_files(args, '') for x in glob.glob(f'{glob.escape(prefix)}*.html'))
+    tut_files = sorted(glob.glob(f'{args.data_path}/Tutorials-Processed/*TUT*/*_SBG.xlsx'))
+    mt_files = sorted(glob.glob(f'{args.data_path}/*Midterm*/*.csv')) if args.compute_exams else []
+    manual_files = course_files(args, 'manualscores.xlsx')
+
+    with lsprofile.stage('load_sources') as st:
+        loaded = load_files([(load_webwork, x) for x in ww_files] +
+                            [(functools.partial(load_tutorial, roster=roster_emails), x) for x in tut_files] +
+                            [(functools.partial(load_midterm, roster=roster_emails), x) for x in mt_files] +
+                            [(load_manual_scores, x) for x in manual_files],
+                            n_workers(args), cache)
+        st['rows'] = sum(len(x) for x in loaded)
+    if cache is not None:
+        print(f'Parse cache: {cache.hits} files reused, {cache.misses} parsed')
+
+    ww_scores = loaded[:len(ww_files)]
+    tut_scores = loaded[len(ww_files):len(ww_files) + len(tut_files)]
+    mt_scores = loaded[len(ww_files) + len(tut_files):len(loaded) - len(manual_files)]
+    manual_scores = loaded[len(loaded) - len(manual_files):]
 
     ##### TUTORIALS #####
     # get a list of all questions from tutorials
     # - use this to compute which questions are graded by
-    all_tut_qs = lsref.loc[lsref['modality'] == 'tutorial', 'reqs'].unique()
-    all_tut_qs = [x.split(',') for x in all_tut_qs]
-    all_tut_qs = sum(all_tut_qs, [])
-    all_tut_qs = [x.split('|')[1] if '|' in x else x for x in all_tut_qs]
-    all_tut_qs = [x.strip() for x in all_tut_qs]
-    all_tut_qs = list(set(all_tut_qs))
+    all_tut_qs = requirements.questions('tutorial')
 
     all_tut_qs_sbg = [
         int(re.search(r'tut\d+\-(\d+)\-\w+', x).group(1)) for x in all_tut_qs
@@ -139,186 +285,152 @@ def load_data(args: argparse.Namespace):
         int(re.search(r'tut(\d+)\-\d+\-\w+', x).group(1)) for x in all_tut_qs
     ]
 
-    def compute_tut_is_graded(utorid: str):
-        ''' For a given tutorial day, compute which questions are graded for a given student '''
-        tut_day = gradebook.loc[utorid, 'tut_day']
-
-        stu_scores = pd.DataFrame(
-            data={
-                'login_name': [utorid] * len(all_tut_qs),
-                'score_key':
-                all_tut_qs,
-                'is_graded': [(wk in tut_sbg_assigned.columns) and (
-                    tut_sbg_assigned.loc[tut_day, wk] == sbg) for q, sbg, wk in
-                              zip(all_tut_qs, all_tut_qs_sbg, all_tut_qs_wk)],
-            })
-
-        return stu_scores
-
-    tut_is_graded = list(map(compute_tut_is_graded, tqdm(roster['UTORid'].unique(), desc='SBGs graded by student')))
-    tut_is_graded = pd.concat(tut_is_graded, ignore_index=True)
-
-    # load tutorial data
-    tut_scores = None
-    for filename in glob.glob(f'{args.data_path}/Tutorials-Processed/*TUT*/*_SBG.xlsx'):
-        print(f'Loading {filename}...')
-        this_score = pd.read_excel(filename)
-
-        # remove sum rows at the bottom
-        this_score = this_score[~(this_score['First Name'].isna() & this_score['Last Name'].isna())]
-
-        # merge with roster
-        this_score = this_score.merge(roster[['Email', 'UTORid']],
-                                      how='left',
-                                      on='Email')
-        this_score = this_score.rename(columns={'UTORid': 'login_name'})
-
-        # remove empty login names
-        this_score = this_score[~this_score['login_name'].isna()
-                                & (this_score['login_name'] != '')]
-
-        ls_cols = [x for x in this_score.columns if '|' in x]
-        this_score = this_score[ls_cols + ['login_name']]
-
-        for ccol in ls_cols:
-            ckey = ccol.split('|')[1].strip()
-            this_score = this_score.rename(columns={ccol: ckey})
-
-        # stack into long format
-        this_score = this_score.melt(id_vars='login_name',
-                                     var_name='score_key',
-                                     value_name='correct')
-
-        # check if this LS was tested for this student for this tutorial by matching it to the SBG column
-        this_score['ls'] = this_score['score_key'].apply(
-            lambda x: re.search(r'.*\d+\-(\d+)\-\w+', x).group(1)).astype(int)
-        this_score.drop(columns=['ls'], inplace=True)
-
-        # concat
-        tut_scores = pd.concat([tut_scores, this_score], ignore_index=True)
-
-    # merge with list of required questions for each student
-    tut_scores = tut_scores.groupby(['login_name',
-                                     'score_key']).max().reset_index()
-    tut_scores = tut_scores.set_index(['login_name', 'score_key'])['correct']
-    tut_is_graded['correct'] = tut_is_graded.apply(
-        lambda x: tut_scores.loc[(x['login_name'], x['score_key'])]
-        if (x['login_name'], x['score_key']) in tut_scores.index else False,
-        axis=1)
-    tut_is_graded['correct'] = tut_is_graded['correct'].fillna(False)
+    # a tutorial question is graded for a student if its SBG was assigned to their tutorial day that week
+    # - cross every student with every tutorial question, then match against the long-format SBG assignments
+    with lsprofile.stage('tut_is_graded') as st:
+        students = roster['UTORid'].unique()
+        stu_days = pd.DataFrame({'login_name': students,
+                                 'tut_day': gradebook['tut_day'].reindex(students).to_numpy()})
+        missing_days = set(stu_days['tut_day']) - set(tut_sbg_assigned.index)
+        if len(all_tut_qs) > 0 and missing_days:
+            raise KeyError(f'Tutorial days missing from sbg_assigned: {sorted(map(str, missing_days))}')
+
+        tut_qs = pd.DataFrame({'score_key': all_tut_qs, 'week': all_tut_qs_wk, 'sbg': all_tut_qs_sbg},
+                              columns=['score_key', 'week', 'sbg']).astype({'week': np.int64, 'sbg': np.int64})
+        sbg_long = tut_sbg_assigned.stack().rename_axis(['tut_day', 'week']).reset_index(name='sbg')
+        sbg_long = sbg_long[sbg_long['week'].isin(all_tut_qs_wk) & sbg_long['sbg'].isin(all_tut_qs_sbg)]
+        sbg_long = sbg_long.astype({'week': np.int64, 'sbg': np.int64}).drop_duplicates()
+
+        tut_is_graded = stu_days.merge(tut_qs, how='cross')
+        tut_is_graded = tut_is_graded.merge(sbg_long, how='left', on=['tut_day', 'week', 'sbg'], indicator=True)
+        tut_is_graded['is_graded'] = (tut_is_graded['_merge'] == 'both').to_numpy()
+        tut_is_graded = tut_is_graded[['login_name', 'score_key', 'is_graded']]
+
+        # combine tutorial data
+        tut_scores = pd.concat(tut_scores, ignore_index=True)
+
+        # merge with list of required questions for each student, ungraded or missing scores are incorrect
+        tut_scores = tut_scores.groupby(['login_name', 'score_key'], as_index=False)['correct'].max()
+        tut_is_graded = tut_is_graded.merge(tut_scores, how='left', on=['login_name', 'score_key'])
+        tut_is_graded['correct'] = tut_is_graded['correct'].astype(object).where(
+            tut_is_graded['correct'].notna(), False)
+        st['rows'] = len(tut_is_graded)
     # tut_is_graded['correct'][~tut_is_graded['is_graded']] = np.nan
 
-    scores = pd.concat([scores, tut_is_graded], ignore_index=True)
-
-    # load midterm data
-    if args.compute_exams:
-        for filename in glob.glob(f'{args.data_path}/*Midterm*/*.csv'):
-            print(f'Loading {filename}...')
-            this_score = pd.read_csv(filename)
-
-            # remove sum rows
-            this_score = this_score[~this_score['SID'].isna()]
-
-            # merge with roster
-            this_score = this_score.merge(roster[['Email', 'UTORid']],
-                                          how='left',
-                                          on='Email')
-            this_score = this_score.rename(columns={'UTORid': 'login_name'})
-
-            # parse score key
-            ls_cols = [x for x in this_score.columns if '|' in x]
-            this_score = this_score[['login_name'] + ls_cols]
-            this_score.columns = ['login_name'
-                                  ] + [x.split('|')[1] for x in ls_cols]
-
-            # stack into long format
-            this_score = this_score.melt(id_vars='login_name',
-                                         var_name='score_key',
-                                         value_name='correct')
-
-            # check if correct has type string, convert to int
-            this_score['correct'] = this_score['correct'].map({
-                'TRUE': 1,
-                'FALSE': 0,
-                True: 1,
-                False: 0
-            })
-
-            # concat
-            scores = pd.concat([scores, this_score], ignore_index=True)
-
-    # load manually scored items
-    manual_scores = pd.read_excel(f'{args.data_path}/mat188-2023f-manualscores.xlsx')
-    scores = pd.concat((scores, manual_scores), ignore_index=True)
+    # WEBWORK, TUTORIALS, MIDTERMS, manual scores
+    # - rows without an associated utorid are dropped as they are appended
+    with lsprofile.stage('build_score_store') as st:
+        scores = scorestore.ScoreStore()
+        for this_score in ww_scores + [tut_is_graded] + mt_scores + manual_scores:
+            scores.append(this_score)
+        st['rows'] = len(scores)
+    del loaded, ww_scores, tut_scores, mt_scores, manual_scores, tut_is_graded
 
-    # remove score rows without an associated utorid
-    scores = scores[scores['login_name'] != ''].dropna(subset=['login_name'])
+    print(scorestore.memory_report(scores))
 
     # save for debugging
-    scores.to_csv(f'{args.output_path}/debug_raw_scores.csv')
-
-    return scores, roster, lsref
-
-def run(args: argparse.Namespace):
-    scores, roster, lsref = load_data(args)
+    if args.dump_scores:
+        with lsprofile.stage('write_debug_scores') as st:
+            lsoutput.write_scores(scores, args.output_path, args.output_format)
+            st['rows'] = len(scores)
+
+    return scores, roster, requirements
+
+def check_options(args: argparse.Namespace):
+    ''' Fail before loading any data if the output format is unavailable or the options conflict '''
+    lsoutput.require_format(args.output_format)
+    if args.batch_size and (args.incremental or args.watch):
+        raise ValueError('--batch-size cannot be combined with --incremental or --watch')
+
+
+def run(args: argparse.Namespace,
+        cache: Optional[lscache.ParseCache] = None,
+        previous: Optional[lsgrade.GradingState] = None) -> lsgrade.GradingState:
+    '''
+    Grade every student and write standards_achieved.
+
+    :param args: command line arguments
+    :param cache: parse cache to reuse, or None to open the one given by args
+    :param previous: grading state of a previous run to regrade incrementally from, or None to load it from the output path when args.incremental is set
+    :return: grading state for the next incremental run, or None with --batch-size
+    '''
+    check_options(args)
+    scores, roster, requirements = load_data(args, cache)
 
     #######################################################################
     # Which learning standards has each student achieved?
     # remove requirements that don't have associated questions in our score db
-    uniq_scorekey = scores['score_key'].unique()
-    for this_idx, this_standard in lsref.iterrows():
-        if (this_standard['reqs'] == '') or pd.isna(this_standard['reqs']):
-            continue
-
-        # parse standards
-        if '|' in this_standard['reqs']:
-            n_req, reqstr = this_standard['reqs'].split('|')[0:2]
-            n_req = int(n_req)
-            reqs = reqstr.split(',')
-        else:
-            reqs = this_standard['reqs'].split(',')
-            n_req = len(reqs)
-
-        in_db = [tr in uniq_scorekey for tr in reqs]
-
-        # only keep standards that have questions in the db
-        reqs = list(compress(reqs, in_db))
-
-        n_req = min(n_req, len(reqs))
-
-        # reconstruct reqs string
-        if n_req > 0:
-            lsref.loc[this_idx, 'reqs'] = str(n_req) + '|' + (','.join(reqs))
-        else:
-            lsref.loc[this_idx, 'reqs'] = pd.NA
-
-    # remove empty standards with no associated items
-    lsref = lsref[~lsref['reqs'].isna()]
-
-    # initialize output table
-    standards_achieved = pd.DataFrame(index=scores['login_name'].unique(),
-                                      columns=pd.MultiIndex.from_frame(lsref[[
-                                          'modality', 'standard'
-                                      ]].drop_duplicates()))
-
-    # with multiple threads, call the grading function for each student
-    with mp.Pool(nthreads) as p:
-        standards_achieved = pd.concat(tqdm(
-            p.imap_unordered(
-                functools.partial(grade_by_ls, lsref=lsref),
-                zip(roster['UTORid'].unique(), [
-                    scores[scores['login_name'] == this_student].set_index(
-                        'score_key')
-                    for this_student in roster['UTORid'].unique()
-                ]),
-                chunksize=10,
-            ),
-            total=len(roster['UTORid'].unique()),
-            desc='Evaluating learning standards by student'),
-                                       axis=1).T
-
+    with lsprofile.stage('prune_requirements') as st:
+        uniq_scorekey = scores.questions[np.unique(scores.q)]
+        requirements = requirements.prune(uniq_scorekey)
+        st['rows'] = len(requirements.requirements)
+
+    with lsprofile.stage('compile_standards'):
+        compiled = lsgrade.compile_standards(requirements)
+
+    students = roster['UTORid'].unique()
+    roster = roster.set_index('UTORid')
+    modalities = compiled.columns.get_level_values('modality').unique()
+    nworkers = n_workers(args)
+
+    db = None
+    if args.db:
+        with lsprofile.stage('update_db_scores') as st:
+            db = lsdb.connect(args.db)
+            st['rows'] = lsdb.update_scores(db, scores)
+            lsdb.update_requirements(db, requirements)
+        print(f'Score database: {st["rows"]} students with changed scores')
+
+    if args.batch_size:
+        run_batched(args, scores, students, roster, compiled, modalities, db)
+        return None
+
+    # group scores by student once, then evaluate blocks of students in parallel,
+    # reusing the previous run's results for students and standards whose inputs are unchanged
+    state_path = f'{args.output_path}/standards_achieved.state.pkl'
+    if previous is None and args.incremental and os.path.exists(state_path):
+        previous = pd.read_pickle(state_path)
+
+    block_size = args.chunksize or max(1, -(-len(students) // (max(nworkers, 1) * 4)))
+    with lsprofile.stage('grade') as st:
+        standards_achieved, state, n_students, n_standards = lsgrade.grade_incremental(
+            scores, students, compiled, previous, nworkers, block_size)
+        st['rows'] = n_students
+    pd.to_pickle(state, state_path + '.tmp')
+    os.replace(state_path + '.tmp', state_path)
+
+    print(f'Evaluated {n_students} of {len(students)} students on {n_standards} of {len(compiled.columns)} standards')
+    print(scorestore.memory_report())
+
+    standards_achieved = summarize_students(standards_achieved, roster, modalities)
+
+    with lsprofile.stage('write_output') as st:
+        lsoutput.write_achieved(standards_achieved, args.output_path, args.output_format)
+        st['rows'] = len(standards_achieved)
+
+    with lsprofile.stage('analytics_cube') as st:
+        standard_counts = lscube.standard_counts(standards_achieved[compiled.columns], roster[lscube.SECTION_COLUMNS])
+        st['rows'] = write_cube(args, scores, roster, standard_counts)
+
+    if db is not None:
+        with lsprofile.stage('update_db_achieved') as st:
+            st['rows'] = lsdb.update_achieved(db, standards_achieved)
+            lsdb.remove_achieved(db, standards_achieved.index)
+            db.close()
+
+    return state
+
+
+def summarize_students(standards_achieved: pd.DataFrame, roster: pd.DataFrame, modalities) -> pd.DataFrame:
+    '''
+    Add the fraction of standards achieved in each modality and the student names to graded rows.
+
+    :param standards_achieved: graded rows from lsgrade, one per student
+    :param roster: roster indexed by UTORid
+    :param modalities: modalities to compute fraction_achieved for
+    :return: the rows of students on the roster, sorted by login name
+    '''
     # compute fraction standards achieved across each modality
-    modalities = lsref['modality'].unique()
     for this_modality in modalities:
         this_modality_standards = standards_achieved.loc[:, this_modality]
         standards_achieved.loc[:,
@@ -327,7 +439,6 @@ def run(args: argparse.Namespace):
                                     axis=1, skipna=True)
 
     # Join student names for easy lookup
-    roster.set_index('UTORid', inplace=True)
     standards_achieved = standards_achieved[standards_achieved.index.isin(
         roster.index)]
     standards_achieved[('student',
@@ -338,26 +449,323 @@ def run(args: argparse.Namespace):
                                                    'Last Name']
     standards_achieved.sort_index(axis=0, inplace=True)
 
-    standards_achieved.to_csv(f'{args.output_path}/standards_achieved.csv')
+    return standards_achieved
+
+
+def write_cube(args: argparse.Namespace, scores: scorestore.ScoreStore, roster: pd.DataFrame,
+               standard_counts: pd.DataFrame) -> int:
+    '''
+    Write the analytics cube of a grading run: the standard counts and the question statistics of the students on the roster.
+
+    :param args: command line arguments
+    :param scores: ScoreStore of every score row
+    :param roster: roster indexed by UTORid, with the tutorial section of each student
+    :param standard_counts: lscube.standard_counts of every graded student
+    :return: number of rows written
+    '''
+    cube = {'standards': standard_counts,
+            'questions': lscube.question_stats(scores, roster[lscube.SECTION_COLUMNS])}
+    paths = lsoutput.write_cube(cube, args.output_path, args.output_format)
+    print(f'Analytics cube: {", ".join(paths.values())}')
+
+    return sum(len(x) for x in cube.values())
+
+
+def run_batched(args: argparse.Namespace, scores: scorestore.ScoreStore, students, roster: pd.DataFrame,
+                compiled: lsgrade.CompiledStandards, modalities, db=None):
+    '''
+    Grade students args.batch_size at a time, writing each batch's rows to standards_achieved as it is graded.
+
+    Students are graded in login name order so that the batches are written in the same order as run
+    would sort the whole table. The cohort's mean fraction_achieved per modality is kept as running sums.
+
+    :param args: command line arguments
+    :param scores: ScoreStore of every score row
+    :param students: login names to grade
+    :param roster: roster indexed by UTORid
+    :param compiled: compiled learning standards
+    :param modalities: modalities to compute fraction_achieved for
+    :param db: score database to also write each batch to, or None
+    '''
+    students = np.sort(students)
+    nworkers = n_workers(args)
+    block_size = args.chunksize or max(1, -(-min(args.batch_size, len(students)) // (max(nworkers, 1) * 4)))
+    fraction_sum = pd.Series(0.0, index=modalities)
+    fraction_count = pd.Series(0, index=modalities)
+    sections = roster[lscube.SECTION_COLUMNS]
+    cube = {'standards': None}
+
+    def batches():
+        for partition in lsgrade.partition_batches(scores, students, compiled, args.batch_size):
+            with lsprofile.stage('grade') as st:
+                batch = lsgrade.grade_parallel(partition, compiled, nworkers, block_size)
+                st['rows'] = len(batch)
+            batch = summarize_students(batch, roster, modalities)
+
+            fractions = batch['fraction_achieved']
+            fraction_sum[:] += fractions.sum()
+            fraction_count[:] += fractions.count()
+            cube['standards'] = lscube.add_standard_counts(
+                cube['standards'], lscube.standard_counts(batch[compiled.columns], sections))
+            if db is not None:
+                lsdb.update_achieved(db, batch)
+            yield batch
+
+    with lsprofile.stage('write_output') as st:
+        st['rows'] = lsoutput.write_achieved_batches(batches(), args.output_path, args.output_format)
+
+    with lsprofile.stage('analytics_cube') as st:
+        st['rows'] = write_cube(args, scores, roster, cube['standards'])
+
+    if db is not None:
+        lsdb.remove_achieved(db, students)
+        db.close()
+
+    print(f'Evaluated {len(students)} students in batches of {args.batch_size} on {len(compiled.columns)} standards')
+    print('Mean fraction achieved: ' + ', '.join(f'{x} {fraction_sum[x] / max(fraction_count[x], 1):.3f}'
+                                                 for x in modalities))
+    print(scorestore.memory_report())
 
 
+#######################################################################
+# Policy sweeps
+
+def override_requirements(requirements: lsgrade.RequirementTable, overrides: list) -> lsgrade.RequirementTable:
+    '''
+    Change some requirements of a grading sheet.
+
+    :param requirements: parsed grading sheet
+    :param overrides: list of 'STANDARD:MODALITY=N' to change a threshold, or 'STANDARD:MODALITY=REQS' to replace (or add) a requirement string
+    :return: RequirementTable
+    :raises ValueError: for a malformed override, or a threshold below 1 or above the number of questions of its requirement
+    '''
+    def check_threshold(override: str, req: lsgrade.Requirement):
+        # prune would drop a threshold of 0 and cap one above the number of questions without a word
+        if not 1 <= req.n_required <= len(req.questions):
+            raise ValueError(f'Threshold {req.n_required} of override {override} is not between 1 and the '
+                             f'{len(req.questions)} questions of the requirement')
+
+    reqs = list(requirements.requirements)
+
+    for override in overrides:
+        m = re.fullmatch(r'([^:=]+):([^:=]+)=(.+)', override)
+        if m is None:
+            raise ValueError(f'Override should be STANDARD:MODALITY=N or STANDARD:MODALITY=REQS, not {override}')
+        standard, modality, value = (x.strip() for x in m.groups())
+        rows = [ri for ri, x in enumerate(reqs) if x.standard == standard and x.modality == modality]
+
+        if value.isdigit():
+            if not rows:
+                raise ValueError(f'No {modality} requirement of {standard} to change the threshold of')
+            for ri in rows:
+                reqs[ri] = lsgrade.Requirement(standard, modality, int(value), reqs[ri].questions)
+                check_threshold(override, reqs[ri])
+        else:
+            try:
+                new = lsgrade.parse_requirements(pd.DataFrame({'standard': [standard], 'modality': [modality],
+                                                               'reqs': [value]})).requirements[0]
+            except ValueError:
+                raise ValueError(f'Threshold of override {override} is not a whole number') from None
+            check_threshold(override, new)
+            for ri in rows:
+                reqs[ri] = new
+            if not rows:
+                reqs.append(new)
+
+    return lsgrade.RequirementTable.from_requirements(reqs)
+
+
+def read_policy_sheet(filename: str, sheet: str) -> pd.DataFrame:
+    ''' Read a sheet in the format of the grading sheet, failing with its name if the workbook does not have it '''
+    with pd.ExcelFile(filename) as book:
+        if sheet not in book.sheet_names:
+            raise ValueError(f'No sheet {sheet} in {filename}')
+        return book.parse(sheet)
+
+
+def load_policies(args: argparse.Namespace) -> dict:
+    '''
+    The grading policies to compare: the grading sheet, then those given by --sheet and --override.
+
+    Only the lookup table and the --sheet workbooks are read, so that every policy can be checked before
+    the exports are loaded.
+
+    :param args: command line arguments
+    :return: dict of policy name -> RequirementTable
+    :raises ValueError: for a repeated policy name or one named grading, a missing sheet, or a malformed sheet or override
+    '''
+    # a repeated name would silently replace the earlier policy
+    names = list(args.sheet) + [name for name, *_ in args.override]
+    for name in dict.fromkeys(names):
+        if name == 'grading':
+            raise ValueError('Policy name grading is reserved for the grading sheet')
+        if names.count(name) > 1:
+            raise ValueError(f'Policy name {name} is given more than once')
+
+    lookup_table = f'{args.data_path}/standards_lookup_table.xlsx'
+    requirements = sheet_requirements(read_policy_sheet(lookup_table, 'grading'), args.compute_exams)
+    policies = {'grading': requirements}
+
+    for sheet in args.sheet:
+        if sheet.endswith('.xlsx'):
+            lsref = read_policy_sheet(sheet, 'grading')
+        else:
+            lsref = read_policy_sheet(lookup_table, sheet)
+        try:
+            policies[sheet] = sheet_requirements(lsref, args.compute_exams)
+        except ValueError as e:
+            raise ValueError(f'Policy {sheet}: {e}') from None
+
+    for name, *overrides in args.override:
+        policies[name] = override_requirements(requirements, overrides)
+
+    return policies
+
+
+def sweep(args: argparse.Namespace):
+    '''
+    Grade every policy from load_policies in one pass and write their achievement rates to policy_sweep.csv.
+
+    :param args: command line arguments
+    '''
+    # a bad sheet or override fails here, before the exports are loaded
+    try:
+        policies = load_policies(args)
+    except (OSError, ValueError) as e:
+        sys.exit(f'Cannot load the policies: {e}')
+
+    scores, roster, _ = load_data(args)
+
+    with lsprofile.stage('compile_policies'):
+        uniq_scorekey = scores.questions[np.unique(scores.q)]
+        policies = {name: x.prune(uniq_scorekey) for name, x in policies.items()}
+        compiled = lsgrade.compile_policies(policies)
+
+    print(f'{len(policies)} policies with {len(compiled.compiled.columns)} distinct requirements')
+
+    students = roster['UTORid'].unique()
+    batch_size = args.batch_size or max(1, len(students))
+    nworkers = n_workers(args)
+    block_size = args.chunksize or max(1, -(-min(batch_size, len(students)) // (max(nworkers, 1) * 4)))
+    with lsprofile.stage('grade') as st:
+        table = lsgrade.sweep_policies(lsgrade.partition_batches(scores, students, compiled.compiled, batch_size),
+                                       compiled, nworkers, block_size)
+        st['rows'] = len(students)
+
+    table.to_csv(f'{args.output_path}/policy_sweep.csv')
+    print(table.loc['fraction_achieved'].xs('rate', axis=1, level=1).to_string(float_format='{:.3f}'.format))
+    print(f'Wrote {args.output_path}/policy_sweep.csv')
+
+
+#######################################################################
+# Watch mode
+
+def scan_inputs(data_path: str, ignore: tuple = ()) -> dict:
+    '''
+    Size and modification time of every file under the data directory.
+
+    :param data_path: data directory
+    :param ignore: directories to skip, e.g. an output directory inside the data directory
+    :return: dict of path -> (size, mtime_ns)
+    '''
+    ignore = set(os.path.abspath(x) for x in ignore)
+    snapshot = {}
+
+    for root, dirs, files in os.walk(data_path):
+        dirs[:] = [x for x in dirs if not x.startswith('.') and os.path.abspath(os.path.join(root, x)) not in ignore]
+        for name in files:
+            # skip hidden files and Office lock files of workbooks that are open
+            if name.startswith('.') or name.startswith('~$'):
+                continue
+
+            path = os.path.join(root, name)
+            try:
+                st = os.stat(path)
+            except FileNotFoundError:
+                continue
+            snapshot[path] = (st.st_size, st.st_mtime_ns)
+
+    return snapshot
+
+
+def watch(args: argparse.Namespace):
+    '''
+    Regrade whenever files in the data directory are added, changed or removed, until interrupted.
+
+    Parsed exports and the grading state stay in memory between updates, so only new or modified
+    exports are parsed and only affected students and standards are regraded. Outputs are replaced
+    atomically. With --generate-reports, only the reports that changed are recompiled.
+
+    :param args: command line arguments
+    '''
+    cache = None if args.no_cache else lscache.ParseCache(args.cache_dir or f'{args.output_path}/.parse_cache')
+    report_args = argparse.Namespace(**vars(args))
+    report_args.per_student = True
+
+    state = None
+    snapshot = {}
+    print(f'Watching {args.data_path} every {args.watch_interval} s, press Ctrl+C to stop')
+
+    try:
+        while True:
+            current = scan_inputs(args.data_path, ignore=(args.output_path, ))
+            if current == snapshot:
+                time.sleep(args.watch_interval)
+                continue
+
+            # wait for exports that are still being copied in
+            time.sleep(args.watch_interval)
+            if scan_inputs(args.data_path, ignore=(args.output_path, )) != current:
+                continue
+
+            changed = sorted(set(current.items()) ^ set(snapshot.items()))
+            print(f'{datetime.datetime.now():%H:%M:%S} {len(set(x for x, _ in changed))} input files changed, updating')
+            snapshot = current
+
+            try:
+                state = run(args, cache, state)
+                if args.generate_reports:
+                    import make_ls_report_v2
+                    make_ls_report_v2.run(report_args)
+            except Exception:
+                # e.g. a half-edited workbook, keep the previous outputs until the next change
+                traceback.print_exc()
+                print('Update failed, outputs were not changed')
+
+    except KeyboardInterrupt:
+        pass
+
 
 #######################################################################
 # Parse arguments
-if __name__ == '__main__':
-    parser = argparse.ArgumentParser()
-    parser.add_argument('--data-path', default='../Data')
-    parser.add_argument('--output-path', default='../Output')
-    parser.add_argument('--debug', action='store_true')
-    parser.add_argument('--compute-exams', action='store_true')
-    parser.add_argument('--generate-reports', action='store_true')
-    args = parser.parse_args()
+def main(args: argparse.Namespace):
+    ''' Grade (or watch, or sweep) with the options from lscli.add_grade_arguments or add_sweep_arguments '''
+    # checked here as well as in run, as watch would report a conflict as a failed update and keep going
+    check_options(args)
 
     if not os.path.exists(args.output_path):
         os.makedirs(args.output_path)
 
-    run(args)
+    if args.profile:
+        lsprofile.enable(f'{args.output_path}/profile' if args.cprofile else None)
+
+    if args.sweep:
+        sweep(args)
+    elif args.watch:
+        watch(args)
+    else:
+        run(args)
 
-    if args.generate_reports:
-        import make_ls_report_v2
-        make_ls_report_v2.run(args)
+        if args.generate_reports:
+            import make_ls_report_v2
+            make_ls_report_v2.run(args)
+
+    if args.profile:
+        print(lsprofile.summary())
+        lsprofile.write_trace(f'{args.output_path}/profile/trace.json')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    lscli.add_grade_arguments(parser)
+    main(parser.parse_args())
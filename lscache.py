@@ -0,0 +1,153 @@
+# # Parse cache for source exports
+#
+# MAT188 2023F at the University of Toronto
+
+# %%
+from typing import Optional
+
+import functools
+import hashlib
+import json
+import os
+import os.path
+
+import pandas as pd
+
+# bump whenever a loader changes what it returns for the same input file
+CACHE_VERSION = 3
+
+
+def _hash_value(value) -> str:
+    ''' Stable digest of a loader argument '''
+    if isinstance(value, (pd.DataFrame, pd.Series)):
+        digest = hashlib.sha256(pd.util.hash_pandas_object(value, index=True).to_numpy().tobytes())
+        digest.update(repr(value.columns if isinstance(value, pd.DataFrame) else value.name).encode())
+        return digest.hexdigest()
+
+    return repr(value)
+
+
+def loader_key(loader) -> str:
+    '''
+    Identify a loader, including any arguments bound with functools.partial.
+
+    :param loader: callable taking a filename
+    :return: string that changes whenever the loader or its bound arguments change
+    '''
+    parts = [str(CACHE_VERSION), pd.__version__]
+    while isinstance(loader, functools.partial):
+        parts.append(repr(tuple(_hash_value(x) for x in loader.args)))
+        parts.extend(f'{k}={_hash_value(v)}' for k, v in sorted(loader.keywords.items()))
+        loader = loader.func
+    parts.append(f'{loader.__module__}.{loader.__qualname__}')
+
+    return '\n'.join(parts)
+
+
+class ParseCache:
+    '''
+    On-disk cache of the DataFrames parsed from source exports.
+
+    Entries are addressed by the file's path and the SHA-256 of its contents together with the loader
+    that parsed it, so an edited export is re-parsed automatically. An index of each file's path, size and
+    mtime avoids re-hashing exports that have not been touched since the last run, and entries loaded by
+    this process are also kept in memory for long-running processes that reload the same exports.
+
+    The index also records the current entry of each (loader, path), so that the entry of an export's
+    previous contents is deleted when it is replaced, and save_index deletes entries of exports that
+    no longer exist, keeping the cache to one entry per loaded file.
+    '''
+
+    def __init__(self, cache_dir: str):
+        os.makedirs(cache_dir, exist_ok=True)
+        self.cache_dir = cache_dir
+        self.index_path = os.path.join(cache_dir, 'index.json')
+        self.hits = 0
+        self.misses = 0
+        self.memory = {}  # (loader key, path) -> (entry path, DataFrame)
+
+        try:
+            with open(self.index_path, 'r') as f:
+                self.index = json.load(f)
+        except (FileNotFoundError, ValueError):
+            self.index = {}
+
+    def content_hash(self, filename: str) -> str:
+        ''' SHA-256 of a file's contents, reusing the indexed hash when its size and mtime are unchanged '''
+        path = os.path.abspath(filename)
+        st = os.stat(path)
+
+        entry = self.index.get(path)
+        if entry is not None and entry['size'] == st.st_size and entry['mtime_ns'] == st.st_mtime_ns:
+            return entry['sha256']
+
+        digest = hashlib.sha256()
+        with open(path, 'rb') as f:
+            for chunk in iter(lambda: f.read(1 << 20), b''):
+                digest.update(chunk)
+
+        # keep the entries recorded for this path, so that put can replace them
+        self.index.setdefault(path, {}).update(size=st.st_size, mtime_ns=st.st_mtime_ns, sha256=digest.hexdigest())
+        return digest.hexdigest()
+
+    def entry_path(self, loader, filename: str) -> str:
+        # loaders may derive values from the file name (e.g. the WeBWorK set id), so the path is part of the key
+        key = f'{loader_key(loader)}\n{os.path.abspath(filename)}\n{self.content_hash(filename)}'
+        key = hashlib.sha256(key.encode()).hexdigest()
+        return os.path.join(self.cache_dir, f'{key}.pkl')
+
+    def _reference(self, loader, filename: str, path: str):
+        ''' Record path as the entry of loader(filename), deleting the entry it replaces '''
+        entries = self.index[os.path.abspath(filename)].setdefault('entries', {})
+        loader_id = hashlib.sha256(loader_key(loader).encode()).hexdigest()
+        name = os.path.basename(path)
+
+        previous = entries.get(loader_id)
+        if previous is not None and previous != name:
+            try:
+                os.remove(os.path.join(self.cache_dir, previous))
+            except FileNotFoundError:
+                pass
+        entries[loader_id] = name
+
+    def get(self, loader, filename: str) -> Optional[pd.DataFrame]:
+        ''' Cached result of loader(filename), or None if it has not been cached '''
+        path = self.entry_path(loader, filename)
+
+        memory_key = (loader_key(loader), os.path.abspath(filename))
+        if memory_key in self.memory and self.memory[memory_key][0] == path:
+            self.hits += 1
+            return self.memory[memory_key][1]
+
+        try:
+            df = pd.read_pickle(path)
+        except Exception:
+            self.misses += 1
+            return None
+
+        self.memory[memory_key] = (path, df)
+        self._reference(loader, filename, path)
+        self.hits += 1
+        return df
+
+    def put(self, loader, filename: str, df: pd.DataFrame):
+        ''' Store the result of loader(filename) '''
+        path = self.entry_path(loader, filename)
+        df.to_pickle(path + '.tmp')
+        os.replace(path + '.tmp', path)
+        self._reference(loader, filename, path)
+
+        self.memory[(loader_key(loader), os.path.abspath(filename))] = (path, df)
+
+    def save_index(self):
+        ''' Write the index, first dropping exports that no longer exist and deleting unreferenced entries '''
+        self.index = {x: entry for x, entry in self.index.items() if os.path.exists(x)}
+
+        referenced = set(name for entry in self.index.values() for name in entry.get('entries', {}).values())
+        for name in os.listdir(self.cache_dir):
+            if name.endswith('.pkl') and name not in referenced:
+                os.remove(os.path.join(self.cache_dir, name))
+
+        with open(self.index_path + '.tmp', 'w') as f:
+            json.dump(self.index, f)
+        os.replace(self.index_path + '.tmp', self.index_path)
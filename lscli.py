@@ -0,0 +1,202 @@
+# # Command line entry point
+#
+# MAT188 2023F at the University of Toronto
+#
+# Usage: python -m lscli {grade,report,sweep,query,parse} [options]
+#
+# Only the standard library is imported here. pandas and the pipeline modules are imported by the
+# subcommand that needs them, so that --help and small commands start quickly.
+
+# %%
+import argparse
+import sys
+
+# same as lsoutput.FORMATS, listed here so that building the parser does not import pandas
+OUTPUT_FORMATS = ['csv', 'parquet', 'feather']
+
+
+def add_data_arguments(parser: argparse.ArgumentParser):
+    ''' Options shared by every command that loads and grades the scores '''
+    parser.add_argument('--data-path', default='../Data')
+    parser.add_argument('--output-path', default='../Output')
+    parser.add_argument('--course-prefix', nargs='+', default=['mat188-2023f'], help='Prefix of the roster, gradebook, manual score and WeBWorK files of each course (or term) to grade together, e.g. mat188-2023f mat188-2024f.')
+    parser.add_argument('--debug', action='store_true')
+    parser.add_argument('--compute-exams', action='store_true')
+    parser.add_argument('--no-cache', action='store_true', help='Re-parse every source export instead of using the parse cache.')
+    parser.add_argument('--workers', type=int, default=None, help='Number of worker processes, defaults to one less than the number of CPUs.')
+    parser.add_argument('--chunksize', type=int, default=None, help='Number of students graded per worker task, defaults to a quarter of an even split.')
+    parser.add_argument('--batch-size', type=int, default=None, help='Grade this many students at a time, so that memory use does not grow with the cohort; cannot be combined with --incremental or --watch.')
+    parser.add_argument('--cache-dir', default=None, help='Parse cache location, defaults to <output-path>/.parse_cache.')
+    parser.add_argument('--profile', action='store_true', help='Print a table of time spent per stage and write a Chrome trace to <output-path>/profile/trace.json.')
+    parser.add_argument('--cprofile', action='store_true', help='With --profile, also dump a cProfile of each top-level stage (and of each file parsed by a worker) to <output-path>/profile.')
+
+
+def add_grade_arguments(parser: argparse.ArgumentParser):
+    ''' Options of lsa_v4 / `lscli grade` '''
+    add_data_arguments(parser)
+    parser.add_argument('--generate-reports', action='store_true')
+    parser.add_argument('--shards', type=int, default=1, help='Number of report documents to compile in parallel.')
+    parser.add_argument('--per-student', action='store_true', help='Compile one report PDF per student, only rebuilding changed reports.')
+    parser.add_argument('--no-format', action='store_true', help='Process the report preamble in every document instead of precompiling it into a pdflatex format.')
+    parser.add_argument('--incremental', action='store_true', help='Only regrade students and standards whose inputs changed since the last run.')
+    parser.add_argument('--output-format', choices=OUTPUT_FORMATS, default='csv', help='File format of standards_achieved (and of the debug score dump); parquet and feather need pyarrow.')
+    parser.add_argument('--dump-scores', action='store_true', help='Write every score row to <output-path>/debug_raw_scores for debugging.')
+    parser.add_argument('--db', default=None, help='SQLite score database to keep up to date with the scores, requirements and results of every run, see `lscli query`.')
+    parser.add_argument('--watch', action='store_true', help='Keep running and regrade whenever files in the data path change, rebuilding changed reports with --generate-reports.')
+    parser.add_argument('--watch-interval', type=float, default=10, help='Seconds between checks for changed files in --watch mode.')
+    parser.set_defaults(sweep=False)
+
+
+def add_sweep_arguments(parser: argparse.ArgumentParser):
+    ''' Options of `lscli sweep` '''
+    add_data_arguments(parser)
+    parser.add_argument('--sheet', action='append', default=[], metavar='SHEET', help='Policy graded from another sheet of the lookup table, or from the grading sheet of another .xlsx file, in the same format as the grading sheet. Can be repeated.')
+    parser.add_argument('--override', action='append', nargs='+', default=[], metavar=('NAME', 'STANDARD:MODALITY=REQS'), help='Policy named NAME (not grading, and different from the other policies) that changes some requirements of the grading sheet, e.g. LS001:webwork=2 to require 2 questions or LS001:webwork=2|ww1-1,ww1-2,ww2-4 to replace the requirement. Can be repeated.')
+    parser.set_defaults(sweep=True, output_format='csv', dump_scores=False, db=None, generate_reports=False, incremental=False, watch=False)
+
+
+def add_report_arguments(parser: argparse.ArgumentParser):
+    ''' Options of make_ls_report_v2 / `lscli report` '''
+    parser.add_argument(
+        '--debug',
+        action='store_true',
+        help='Run in debug mode, only generate 20 reports for testing.')
+    parser.add_argument('--data-path', default='../Data')
+    parser.add_argument('--output-path', default='../Output')
+    parser.add_argument(
+        '--course-prefix',
+        nargs='+',
+        default=['mat188-2023f'],
+        help='Prefix of the roster file of each course (or term) that was graded.')
+    parser.add_argument(
+        '--shards',
+        type=int,
+        default=1,
+        help='Split the reports into this many documents and compile them in parallel.')
+    parser.add_argument(
+        '--per-student',
+        action='store_true',
+        help='Compile one PDF per student, only rebuilding reports that changed, then combine them.')
+    parser.add_argument(
+        '--no-format',
+        action='store_true',
+        help='Process the preamble in every document instead of precompiling it into a pdflatex format, which is rebuilt whenever the header or the LaTeX sources change.')
+    parser.add_argument(
+        '--output-format',
+        choices=OUTPUT_FORMATS,
+        default=None,
+        help='Format of the standards_achieved file to read, defaults to the most recently written one.')
+    parser.add_argument(
+        '--db',
+        default=None,
+        help='Read the standards achieved from this score database (written by grade --db) instead of the standards_achieved file.')
+    parser.add_argument(
+        '--profile',
+        action='store_true',
+        help='Print a table of time spent per stage and write a Chrome trace to <output-path>/profile/report_trace.json.')
+    parser.add_argument(
+        '--cprofile',
+        action='store_true',
+        help='With --profile, also dump a cProfile of each top-level stage to <output-path>/profile.')
+
+
+def add_parse_arguments(parser: argparse.ArgumentParser):
+    ''' Options of `lscli parse` '''
+    parser.add_argument('filename', help='WeBWorK student progress HTML export.')
+    parser.add_argument('--engine', choices=['stream', 'bs4'], default='stream', help='HTML parser, see wwparse.parse_html.')
+    parser.add_argument('--wide', action='store_true', help='Keep one row per student instead of one row per problem.')
+    parser.add_argument('--output', default=None, help='CSV file to write, defaults to standard output.')
+
+
+def add_check_table_arguments(parser: argparse.ArgumentParser):
+    ''' Options of `lscli check-table` '''
+    parser.add_argument('filename', nargs='?', default=None, help='Lookup table to check, defaults to <data-path>/standards_lookup_table.xlsx.')
+    parser.add_argument('--data-path', default='../Data')
+    parser.add_argument('--sheet', action='append', default=[], metavar='SHEET', help='Also check this sheet in the format of the grading sheet, e.g. a policy for sweep. Can be repeated.')
+
+
+def add_query_arguments(parser: argparse.ArgumentParser):
+    ''' Options of `lscli query` '''
+    parser.add_argument('db', help='Score database written by grade --db.')
+    parser.add_argument('student', help='Login name.')
+    parser.add_argument('standard', help='Learning standard.')
+
+
+def grade(args: argparse.Namespace):
+    import lsa_v4
+    lsa_v4.main(args)
+
+
+def report(args: argparse.Namespace):
+    import make_ls_report_v2
+    make_ls_report_v2.main(args)
+
+
+def query(args: argparse.Namespace):
+    import lsdb
+    try:
+        trail = lsdb.evidence(args.db, args.student, args.standard)
+    except (KeyError, FileNotFoundError) as e:
+        sys.exit(e.args[0])
+    print(lsdb.format_evidence(args.student, args.standard, trail))
+
+
+def parse(args: argparse.Namespace):
+    import wwparse
+    df = wwparse.parse_html(args.filename, save_csv=False, stacked=not args.wide, engine=args.engine)
+    df.to_csv(args.output or sys.stdout, index=False)
+
+
+def check_table(args: argparse.Namespace):
+    import lstable
+    filename = args.filename or f'{args.data_path}/standards_lookup_table.xlsx'
+    try:
+        problems = lstable.check_table(filename, args.sheet)
+    except (OSError, KeyError, ValueError) as e:
+        sys.exit(f'Cannot read {filename}: {e}')
+
+    for x in problems:
+        print(x)
+    if problems:
+        sys.exit(f'{len(problems)} problems in {filename}')
+    print(f'{filename}: OK')
+
+
+def build_parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(prog='python -m lscli', description='Grade learning standards and build student reports.')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    grade_parser = subparsers.add_parser('grade', help='Compute the standards achieved by every student (lsa_v4).')
+    add_grade_arguments(grade_parser)
+    grade_parser.set_defaults(func=grade)
+
+    report_parser = subparsers.add_parser('report', help='Build the learning standard report PDFs (make_ls_report_v2).')
+    add_report_arguments(report_parser)
+    report_parser.set_defaults(func=report)
+
+    sweep_parser = subparsers.add_parser('sweep', help='Compare achievement rates under several variants of the grading sheet, grading them all in one pass.')
+    add_sweep_arguments(sweep_parser)
+    sweep_parser.set_defaults(func=grade)
+
+    query_parser = subparsers.add_parser('query', help="Show the requirements, results and score rows behind a student's result on a standard.")
+    add_query_arguments(query_parser)
+    query_parser.set_defaults(func=query)
+
+    check_parser = subparsers.add_parser('check-table', help='Check the learning standards lookup table for problems before grading.')
+    add_check_table_arguments(check_parser)
+    check_parser.set_defaults(func=check_table)
+
+    parse_parser = subparsers.add_parser('parse', help='Parse one WeBWorK progress export to CSV.')
+    add_parse_arguments(parse_parser)
+    parse_parser.set_defaults(func=parse)
+
+    return parser
+
+
+def main(argv: list = None):
+    args = build_parser().parse_args(argv)
+    args.func(args)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,148 @@
+# # Cohort analytics cube
+#
+# MAT188 2023F at the University of Toronto
+#
+# Aggregates of a grading run for dashboards: how many students achieved, did not achieve or were
+# not tested on each standard in each tutorial section, and how each question was answered. Every
+# measure is a count or sum, so slices can be added up and rates computed from them.
+
+# %%
+import numpy as np
+import pandas as pd
+
+import scorestore
+
+SECTION_COLUMNS = ['tut', 'tut_day']
+
+STANDARD_MEASURES = ['achieved', 'not_achieved', 'untested']
+
+QUESTION_MEASURES = ['n_rows', 'n_correct', 'n_incorrect', 'n_untested', 'n_ungraded',
+                     'n_attempted', 'n_incor_sum', 'n_incor_max', 'n_first_try']
+
+
+def _section_codes(sections: pd.DataFrame):
+    '''
+    Code each student's tutorial section.
+
+    :param sections: one row per student with columns SECTION_COLUMNS
+    :return: (int64 code per student, DataFrame of SECTION_COLUMNS with one row per code)
+    '''
+    codes, uniques = pd.factorize(pd.MultiIndex.from_frame(sections[SECTION_COLUMNS]), use_na_sentinel=False)
+    return codes, pd.DataFrame(list(uniques), columns=SECTION_COLUMNS)
+
+
+def _cube_frame(keys: dict, measures: dict) -> pd.DataFrame:
+    ''' Long-format cube with categorical key columns and int32 measures '''
+    frame = pd.DataFrame({k: pd.Categorical(v) for k, v in keys.items()})
+    for name, values in measures.items():
+        frame[name] = values.astype(np.int32)
+    return frame
+
+
+def standard_counts(standards_achieved: pd.DataFrame, sections: pd.DataFrame) -> pd.DataFrame:
+    '''
+    Count the students who achieved, did not achieve and were not tested on each standard, by tutorial section.
+
+    All columns are counted at once, with one matrix product per outcome.
+
+    :param standards_achieved: 1/0/NaN table with one row per student and (modality, standard) columns
+    :param sections: tutorial section (SECTION_COLUMNS) of every student in standards_achieved, indexed by login name
+    :return: DataFrame with columns modality, standard, tut, tut_day and STANDARD_MEASURES
+    '''
+    codes, uniques = _section_codes(sections.loc[standards_achieved.index])
+
+    # n_sections x n_students indicator, so that one product sums each section's students
+    members = np.zeros((len(uniques), len(codes)), dtype=np.int32)
+    members[codes, np.arange(len(codes))] = 1
+
+    values = standards_achieved.to_numpy(dtype=np.float64)
+    counts = {'achieved': members @ (values == 1).astype(np.int32),
+              'not_achieved': members @ (values == 0).astype(np.int32),
+              'untested': members @ np.isnan(values).astype(np.int32)}
+
+    # flatten n_sections x n_columns to one row per (column, section)
+    n_columns = values.shape[1]
+    columns = standards_achieved.columns
+    keys = {'modality': np.repeat(columns.get_level_values(0), len(uniques)),
+            'standard': np.repeat(columns.get_level_values(1), len(uniques))}
+    for x in SECTION_COLUMNS:
+        keys[x] = np.tile(uniques[x].to_numpy(), n_columns)
+
+    return _cube_frame(keys, {k: v.T.ravel() for k, v in counts.items()})
+
+
+def add_standard_counts(total: pd.DataFrame, counts: pd.DataFrame) -> pd.DataFrame:
+    '''
+    Add up the standard_counts of two groups of students, e.g. of batches graded separately.
+
+    :param total: standard_counts so far, or None
+    :param counts: standard_counts to add
+    :return: DataFrame as returned by standard_counts
+    '''
+    if total is None:
+        return counts
+
+    keys = ['modality', 'standard'] + SECTION_COLUMNS
+    both = pd.concat([total, counts], ignore_index=True)
+    summed = both.groupby(keys, sort=False, dropna=False, observed=True)[STANDARD_MEASURES].sum()
+    return _cube_frame({k: summed.index.get_level_values(k) for k in keys},
+                       {k: summed[k].to_numpy() for k in STANDARD_MEASURES})
+
+
+def question_stats(scores: scorestore.ScoreStore, sections: pd.DataFrame) -> pd.DataFrame:
+    '''
+    Answer and attempt statistics of every score key, by tutorial section.
+
+    Only score rows of students in sections are counted. Rows of questions that were not graded for
+    the student (e.g. tutorial SBGs not assigned to their day) are counted in n_ungraded only. Of
+    the others, n_correct, n_incorrect and n_untested count rows by their correct value. WeBWorK
+    rows carry the number of incorrect attempts (n_incor): n_attempted counts those rows, with
+    n_incor_sum and n_incor_max over them, and n_first_try counts the ones correct without an
+    incorrect attempt.
+
+    :param scores: ScoreStore of every score row
+    :param sections: tutorial section (SECTION_COLUMNS) of each student, indexed by login name
+    :return: DataFrame with columns score_key, tut, tut_day and QUESTION_MEASURES, n_incor_max being -1 without attempted rows
+    '''
+    codes, uniques = _section_codes(sections)
+    n_sections, n_questions = len(uniques), len(scores.questions)
+
+    # section of each student code in the store, -1 for students without one
+    stu_section = np.full(len(scores.students), -1, dtype=np.int64)
+    stu_codes = scores.students.get_indexer(sections.index)
+    stu_section[stu_codes[stu_codes >= 0]] = codes[stu_codes >= 0]
+
+    section = stu_section[scores.stu]
+    rows = section >= 0
+    cell = scores.q[rows].astype(np.int64) * n_sections + section[rows]
+    correct, graded, n_incor = scores.correct[rows], scores.graded[rows], scores.n_incor[rows]
+
+    ungraded = graded == scorestore.UNGRADED
+    attempted = ~ungraded & (n_incor >= 0)
+
+    def count(mask: np.ndarray) -> np.ndarray:
+        return np.bincount(cell[mask], minlength=n_questions * n_sections)
+
+    n_incor_max = np.full(n_questions * n_sections, -1, dtype=np.int64)
+    np.maximum.at(n_incor_max, cell[attempted], n_incor[attempted])
+
+    measures = {
+        'n_rows': count(np.ones(len(cell), dtype=bool)),
+        'n_correct': count(~ungraded & (correct == scorestore.CORRECT)),
+        'n_incorrect': count(~ungraded & (correct == scorestore.INCORRECT)),
+        'n_untested': count(~ungraded & (correct == scorestore.UNTESTED)),
+        'n_ungraded': count(ungraded),
+        'n_attempted': count(attempted),
+        'n_incor_sum': np.bincount(cell[attempted], weights=n_incor[attempted],
+                                   minlength=n_questions * n_sections).astype(np.int64),
+        'n_incor_max': n_incor_max,
+        'n_first_try': count(attempted & (correct == scorestore.CORRECT) & (n_incor == 0)),
+    }
+
+    # only keep (question, section) cells that have rows
+    keep = np.flatnonzero(measures['n_rows'])
+    keys = {'score_key': scores.questions.to_numpy()[keep // n_sections]}
+    for x in SECTION_COLUMNS:
+        keys[x] = uniques[x].to_numpy()[keep % n_sections]
+
+    return _cube_frame(keys, {k: v[keep] for k, v in measures.items()})
@@ -0,0 +1,341 @@
+# # Score database
+#
+# MAT188 2023F at the University of Toronto
+#
+# Keeps the normalized score rows, the requirements they were graded against and the graded results in
+# an indexed SQLite file, so that one student's evidence for one standard can be looked up without
+# loading the exports. Each run only rewrites the students whose score rows or results changed.
+#
+# Only the standard library is imported at module level, so that queries start quickly; pandas and
+# numpy are imported by the functions that write the database or read it into a DataFrame.
+
+# %%
+import os
+import os.path
+import sqlite3
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS students (
+    login_name TEXT PRIMARY KEY,
+    first_name TEXT,
+    last_name TEXT,
+    scores_fp INTEGER,  -- fingerprint of the student's score rows
+    achieved_fp INTEGER  -- fingerprint of the student's row of standards_achieved
+);
+CREATE TABLE IF NOT EXISTS scores (
+    login_name TEXT NOT NULL,
+    score_key TEXT NOT NULL,
+    correct INTEGER,  -- 1/0, NULL when the source has no value
+    is_graded INTEGER,  -- 1/0, NULL when the source does not say
+    score REAL,  -- WeBWorK percentage
+    n_incor INTEGER  -- WeBWorK incorrect attempts
+);
+CREATE INDEX IF NOT EXISTS scores_login_key ON scores (login_name, score_key);
+CREATE TABLE IF NOT EXISTS requirements (
+    standard TEXT NOT NULL,
+    modality TEXT NOT NULL,
+    reqs TEXT NOT NULL,
+    n_required INTEGER NOT NULL
+);
+CREATE INDEX IF NOT EXISTS requirements_standard ON requirements (standard);
+CREATE TABLE IF NOT EXISTS requirement_questions (
+    standard TEXT NOT NULL,
+    modality TEXT NOT NULL,
+    position INTEGER NOT NULL,
+    score_key TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS requirement_questions_standard ON requirement_questions (standard);
+CREATE TABLE IF NOT EXISTS achieved (
+    login_name TEXT NOT NULL,
+    modality TEXT NOT NULL,  -- first level of the standards_achieved columns, e.g. webwork or fraction_achieved
+    standard TEXT NOT NULL,  -- second level, e.g. the standard or, for fraction_achieved, the modality
+    achieved REAL  -- NULL when not tested
+);
+CREATE INDEX IF NOT EXISTS achieved_standard ON achieved (standard, modality);
+CREATE INDEX IF NOT EXISTS achieved_login ON achieved (login_name);
+CREATE TABLE IF NOT EXISTS achieved_columns (
+    position INTEGER PRIMARY KEY,
+    modality TEXT NOT NULL,
+    standard TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS meta (
+    key TEXT PRIMARY KEY,
+    value TEXT
+);
+'''
+
+# columns of standards_achieved that are stored in the students table rather than in achieved
+STUDENT_GROUP = 'student'
+
+
+def connect(path: str) -> sqlite3.Connection:
+    ''' Open (and create if needed) a score database '''
+    if os.path.dirname(path):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+
+    conn = sqlite3.connect(path)
+    conn.executescript(SCHEMA)
+    return conn
+
+
+def _nullable(values, missing):
+    ''' Object array of values with None where missing, for binding as SQL NULL '''
+    import numpy as np
+
+    values = values.astype(object)
+    values[np.asarray(missing, dtype=bool)] = None
+    return values
+
+
+def _delete_students(conn: sqlite3.Connection, table: str, logins: list):
+    for lo in range(0, len(logins), 500):
+        chunk = logins[lo:lo + 500]
+        conn.execute(f'DELETE FROM {table} WHERE login_name IN ({",".join("?" * len(chunk))})', chunk)
+
+
+def _stored_fingerprints(conn: sqlite3.Connection, field: str) -> dict:
+    return dict(conn.execute(f'SELECT login_name, {field} FROM students'))
+
+
+def _set_fingerprints(conn: sqlite3.Connection, field: str, fingerprints: dict):
+    conn.executemany(f'INSERT INTO students (login_name, {field}) VALUES (?, ?) '
+                     f'ON CONFLICT (login_name) DO UPDATE SET {field} = excluded.{field}',
+                     fingerprints.items())
+
+
+def update_scores(conn: sqlite3.Connection, scores) -> int:
+    '''
+    Replace the score rows of every student whose rows changed since the last update, and remove
+    students that are no longer in the scores.
+
+    :param conn: score database
+    :param scores: ScoreStore of every score row
+    :return: number of students whose rows were rewritten
+    '''
+    import numpy as np
+    import pandas as pd
+    from scorestore import UNTESTED, UNSPECIFIED, GRADED
+
+    students = scores.students.to_numpy()
+    questions = scores.questions.to_numpy()
+
+    # order-independent fingerprint of each student's rows: the sum of their row hashes
+    fp = np.zeros(len(students), dtype=np.uint64)
+    for frame in scores.iter_frames():
+        codes = frame['login_name'].cat.codes.to_numpy()
+        np.add.at(fp, codes, pd.util.hash_pandas_object(frame, index=False).to_numpy())
+    fp = fp.view(np.int64)
+
+    stored = _stored_fingerprints(conn, 'scores_fp')
+    changed = np.array([stored.get(x) != int(f) for x, f in zip(students, fp)], dtype=bool)
+    present = set(students)
+    removed = sorted(x for x, f in stored.items() if f is not None and x not in present)
+
+    rows = np.flatnonzero(changed[scores.stu])
+    stu, q = scores.stu[rows], scores.q[rows]
+    correct, graded = scores.correct[rows], scores.graded[rows]
+    score, n_incor = scores.score[rows], scores.n_incor[rows]
+
+    with conn:
+        _delete_students(conn, 'scores', list(students[changed]) + removed)
+        conn.executemany('UPDATE students SET scores_fp = NULL WHERE login_name = ?', [(x, ) for x in removed])
+        conn.executemany('INSERT INTO scores VALUES (?, ?, ?, ?, ?, ?)', zip(
+            students[stu], questions[q],
+            _nullable(correct.astype(np.int64), correct == UNTESTED),
+            _nullable((graded == GRADED).astype(np.int64), graded == UNSPECIFIED),
+            _nullable(score.astype(np.float64), np.isnan(score)),
+            _nullable(n_incor.astype(np.int64), n_incor < 0)))
+        _set_fingerprints(conn, 'scores_fp', {x: int(f) for x, f in zip(students[changed], fp[changed])})
+        conn.execute('DELETE FROM students WHERE scores_fp IS NULL AND achieved_fp IS NULL')
+
+    return int(changed.sum())
+
+
+def update_requirements(conn: sqlite3.Connection, requirements) -> bool:
+    '''
+    Replace the stored requirements if they changed.
+
+    :param conn: score database
+    :param requirements: RequirementTable the scores are graded against
+    :return: whether they changed
+    '''
+    key = '\n'.join(f'{x.standard}\t{x.modality}\t{x.reqs}' for x in requirements.requirements)
+    stored = conn.execute("SELECT value FROM meta WHERE key = 'requirements'").fetchone()
+    if stored is not None and stored[0] == key:
+        return False
+
+    with conn:
+        conn.execute('DELETE FROM requirements')
+        conn.execute('DELETE FROM requirement_questions')
+        conn.executemany('INSERT INTO requirements VALUES (?, ?, ?, ?)',
+                         [(x.standard, x.modality, x.reqs, x.n_required) for x in requirements.requirements])
+        conn.executemany('INSERT INTO requirement_questions VALUES (?, ?, ?, ?)',
+                         [(x.standard, x.modality, qi, q) for x in requirements.requirements
+                          for qi, q in enumerate(x.questions)])
+        conn.execute("INSERT OR REPLACE INTO meta VALUES ('requirements', ?)", (key, ))
+
+    return True
+
+
+def update_achieved(conn: sqlite3.Connection, standards_achieved) -> int:
+    '''
+    Store rows of the standards_achieved table, rewriting only the students whose row changed.
+
+    Can be called once per batch of students; call remove_achieved afterwards to drop students that
+    are no longer graded.
+
+    :param conn: score database
+    :param standards_achieved: table with one row per student and (group, name) columns, as written by lsoutput
+    :return: number of students whose rows were rewritten
+    '''
+    import numpy as np
+    import pandas as pd
+
+    names = standards_achieved[STUDENT_GROUP] if STUDENT_GROUP in standards_achieved.columns.get_level_values(0) else None
+    values = standards_achieved.drop(columns=[STUDENT_GROUP], level=0, errors='ignore')
+
+    fp = pd.util.hash_pandas_object(standards_achieved, index=True).to_numpy().view(np.int64)
+    stored = _stored_fingerprints(conn, 'achieved_fp')
+    changed = np.array([stored.get(x) != int(f) for x, f in zip(standards_achieved.index, fp)], dtype=bool)
+    logins = standards_achieved.index[changed]
+
+    long = values[changed].to_numpy(dtype=np.float64)
+    rows = zip(np.repeat(logins.to_numpy(), long.shape[1]),
+               np.tile(values.columns.get_level_values(0).to_numpy(), len(logins)),
+               np.tile(values.columns.get_level_values(1).to_numpy(), len(logins)),
+               _nullable(long.ravel(), np.isnan(long.ravel())))
+
+    with conn:
+        conn.execute('DELETE FROM achieved_columns')
+        conn.executemany('INSERT INTO achieved_columns VALUES (?, ?, ?)',
+                         [(ci, m, s) for ci, (m, s) in enumerate(values.columns)])
+
+        _delete_students(conn, 'achieved', list(logins))
+        conn.executemany('INSERT INTO achieved VALUES (?, ?, ?, ?)', rows)
+        _set_fingerprints(conn, 'achieved_fp', {x: int(f) for x, f in zip(logins, fp[changed])})
+        if names is not None:
+            conn.executemany('UPDATE students SET first_name = ?, last_name = ? WHERE login_name = ?',
+                             zip(_nullable(names.loc[logins, 'first_name'].to_numpy(), names.loc[logins, 'first_name'].isna()),
+                                 _nullable(names.loc[logins, 'last_name'].to_numpy(), names.loc[logins, 'last_name'].isna()),
+                                 logins))
+
+    return int(changed.sum())
+
+
+def remove_achieved(conn: sqlite3.Connection, graded):
+    '''
+    Remove the results of students that are not in graded, e.g. students who dropped the course.
+
+    :param conn: score database
+    :param graded: login names of every student in standards_achieved
+    '''
+    graded = set(graded)
+    stale = [x for x, fp in _stored_fingerprints(conn, 'achieved_fp').items() if fp is not None and x not in graded]
+
+    with conn:
+        _delete_students(conn, 'achieved', stale)
+        conn.executemany('UPDATE students SET achieved_fp = NULL, first_name = NULL, last_name = NULL '
+                         'WHERE login_name = ?', [(x, ) for x in stale])
+        conn.execute('DELETE FROM students WHERE scores_fp IS NULL AND achieved_fp IS NULL')
+
+
+def read_achieved(path: str):
+    '''
+    Rebuild the standards_achieved table from a score database, as read by lsoutput.read_achieved.
+
+    :param path: score database
+    :return: DataFrame with one row per student and two-level columns
+    '''
+    import pandas as pd
+
+    conn = sqlite3.connect(f'file:{path}?mode=ro', uri=True)
+    try:
+        columns = pd.MultiIndex.from_tuples(
+            conn.execute('SELECT modality, standard FROM achieved_columns ORDER BY position').fetchall())
+        achieved = pd.read_sql_query('SELECT login_name, modality, standard, achieved FROM achieved', conn)
+        names = pd.read_sql_query('SELECT login_name, first_name, last_name FROM students '
+                                  'WHERE achieved_fp IS NOT NULL', conn, index_col='login_name')
+    finally:
+        conn.close()
+
+    table = achieved.pivot(index='login_name', columns=['modality', 'standard'], values='achieved')
+    table = table.reindex(columns=columns).astype('float64')
+    table[(STUDENT_GROUP, 'first_name')] = names['first_name']
+    table[(STUDENT_GROUP, 'last_name')] = names['last_name']
+    table.index.name = None
+    table.columns.names = [None, None]
+
+    return table.sort_index()
+
+
+# results of evidence() besides achieved, not achieved and not tested
+NOT_ON_ROSTER = 'not graded (not on the roster)'
+NO_RESULT = 'not graded (no result stored, rerun grade --db)'
+
+
+def evidence(path: str, login_name: str, standard: str) -> list:
+    '''
+    Everything that decided whether a student achieved a standard.
+
+    :param path: score database
+    :param login_name: student
+    :param standard: learning standard
+    :return: list of (modality, requirement string, result, list of (score_key, correct, is_graded, score, n_incor) score rows); a question without score rows is listed with None fields
+    :raises KeyError: if the student is not in the database
+
+    The result is 'achieved', 'not achieved' or 'not tested' (NaN) as graded, NOT_ON_ROSTER when
+    the student has no results at all (e.g. staff accounts and students who dropped the course), or
+    NO_RESULT when they were graded but not on this requirement.
+    '''
+    if not os.path.exists(path):
+        raise FileNotFoundError(f'No score database at {path}')
+
+    conn = sqlite3.connect(f'file:{path}?mode=ro', uri=True)
+    try:
+        student = conn.execute('SELECT achieved_fp FROM students WHERE login_name = ?', (login_name, )).fetchone()
+        if student is None:
+            raise KeyError(f'No student {login_name} in {path}')
+
+        # a NULL achieved value is a NaN result, while a missing row means the student was not graded on it
+        requirements = conn.execute(
+            'SELECT r.modality, r.reqs, a.achieved, a.rowid IS NOT NULL FROM requirements r '
+            'LEFT JOIN achieved a ON a.login_name = ? AND a.standard = r.standard AND a.modality = r.modality '
+            'WHERE r.standard = ? ORDER BY r.rowid', (login_name, standard)).fetchall()
+
+        trail = []
+        for modality, reqs, achieved, has_result in requirements:
+            if student[0] is None:
+                result = NOT_ON_ROSTER
+            elif not has_result:
+                result = NO_RESULT
+            else:
+                result = {None: 'not tested', 1.0: 'achieved', 0.0: 'not achieved'}[achieved]
+
+            rows = conn.execute(
+                'SELECT q.score_key, s.correct, s.is_graded, s.score, s.n_incor FROM requirement_questions q '
+                'LEFT JOIN scores s ON s.login_name = ? AND s.score_key = q.score_key '
+                'WHERE q.standard = ? AND q.modality = ? ORDER BY q.position, s.rowid',
+                (login_name, standard, modality)).fetchall()
+            trail.append((modality, reqs, result, rows))
+    finally:
+        conn.close()
+
+    return trail
+
+
+def format_evidence(login_name: str, standard: str, trail: list) -> str:
+    ''' Text table of evidence() '''
+    def show(x):
+        return '-' if x is None else f'{x:g}' if isinstance(x, float) else str(x)
+
+    lines = [f'{login_name} / {standard}']
+    if not trail:
+        lines.append('  no requirements stored for this standard')
+
+    for modality, reqs, result, rows in trail:
+        lines.append(f'  {modality:10s} {reqs}  -> {result}')
+        for score_key, correct, is_graded, score, n_incor in rows:
+            lines.append(f'    {score_key:16s} correct {show(correct):2s} graded {show(is_graded):2s} '
+                         f'score {show(score):>5s}  incorrect attempts {show(n_incor)}')
+
+    return '\n'.join(lines)
@@ -0,0 +1,613 @@
+# # Learning Standards Grading Engine
+#
+# MAT188 2023F at the University of Toronto
+
+# %%
+from typing import Optional
+from dataclasses import dataclass
+from multiprocessing import shared_memory
+import multiprocessing as mp
+
+import numpy as np
+import pandas as pd
+
+import lstable
+from scorestore import ScoreStore, UNGRADED
+
+
+#######################################################################
+# Requirements
+
+@dataclass
+class Requirement:
+    '''
+    One (standard, modality) row of the grading sheet.
+    '''
+    standard: str
+    modality: str
+    n_required: int  # number of questions that must be correct
+    questions: tuple  # score keys in the order listed, a key listed twice counts twice
+
+    @property
+    def reqs(self) -> str:
+        ''' Requirement string in the lookup table's ``n|key,key,...`` format '''
+        return f'{self.n_required}|' + ','.join(self.questions)
+
+
+@dataclass
+class RequirementTable:
+    '''
+    Parsed grading sheet with reverse indexes from score keys and modalities to its requirements.
+    '''
+    requirements: list  # Requirement per row of the grading sheet
+    by_question: dict  # score key -> positions in requirements that list it
+    by_modality: dict  # modality -> positions in requirements
+
+    @classmethod
+    def from_requirements(cls, requirements: list) -> 'RequirementTable':
+        by_question, by_modality = {}, {}
+        for ri, req in enumerate(requirements):
+            by_modality.setdefault(req.modality, []).append(ri)
+            for q in dict.fromkeys(req.questions):
+                by_question.setdefault(q, []).append(ri)
+
+        return cls(requirements=requirements, by_question=by_question, by_modality=by_modality)
+
+    def questions(self, modality: Optional[str] = None) -> list:
+        ''' Unique score keys in order of first appearance, optionally only those of one modality '''
+        if modality is None:
+            return list(self.by_question)
+
+        rows = self.by_modality.get(modality, [])
+        return list(dict.fromkeys(q for ri in rows for q in self.requirements[ri].questions))
+
+    def prune(self, available) -> 'RequirementTable':
+        '''
+        Drop questions that have no scores, lowering thresholds to the number of questions left, and
+        drop requirements left without questions.
+
+        :param available: score keys present in the scores
+        :return: RequirementTable
+        '''
+        missing = set(self.by_question) - set(available)
+        affected = set(ri for q in missing for ri in self.by_question[q])
+
+        requirements = []
+        for ri, req in enumerate(self.requirements):
+            questions = tuple(q for q in req.questions if q not in missing) if ri in affected else req.questions
+            n_required = min(req.n_required, len(questions))
+
+            if n_required > 0:
+                requirements.append(Requirement(req.standard, req.modality, n_required, questions))
+
+        return RequirementTable.from_requirements(requirements)
+
+
+def parse_requirements(lsref: pd.DataFrame) -> RequirementTable:
+    '''
+    Parse the requirement strings of the learning standards lookup table.
+
+    A requirement string lists score keys separated by commas, optionally prefixed by ``n|`` when
+    only ``n`` of them must be correct. Rows without a requirement string are skipped.
+
+    :param lsref: long-format lookup table with columns ['standard', 'modality', 'reqs']
+    :return: RequirementTable
+    '''
+    requirements = []
+    for standard, modality, reqs in zip(lsref['standard'], lsref['modality'], lsref['reqs']):
+        if pd.isna(reqs) or reqs == '':
+            continue
+
+        n_required, questions = lstable.split_requirement(reqs)
+        requirements.append(Requirement(standard, modality, len(questions) if n_required is None else n_required,
+                                        questions))
+
+    return RequirementTable.from_requirements(requirements)
+
+
+#######################################################################
+# Grading
+
+@dataclass
+class CompiledStandards:
+    '''
+    Learning standard requirements compiled into matrix form.
+
+    Row ``i`` of ``req_matrix`` corresponds to requirement ``i`` of the RequirementTable it was
+    compiled from and counts how many times each question in ``questions`` is listed in it.
+    '''
+    columns: pd.MultiIndex  # (modality, standard) columns of the standards_achieved table
+    questions: pd.Index  # every score key referenced by at least one requirement
+    req_matrix: np.ndarray  # n_rows x n_questions requirement counts
+    reqs: np.ndarray  # per row, the requirement string it was compiled from
+    ratio_required: np.ndarray  # per row, fraction of graded questions that must be correct
+    col_rows: np.ndarray  # per output column, the row that determines it
+
+
+def compile_standards(requirements) -> CompiledStandards:
+    '''
+    Compile learning standard requirements into a requirement matrix.
+
+    :param requirements: RequirementTable, or a long-format lookup table with columns ['standard', 'modality', 'reqs']
+    :return: CompiledStandards
+    '''
+    if isinstance(requirements, pd.DataFrame):
+        requirements = parse_requirements(requirements)
+    reqs = requirements.requirements
+
+    questions = pd.Index(requirements.questions(), dtype=object)
+
+    # count repeated questions so that they are weighted the same as when listed once per occurrence
+    row_idx = np.repeat(np.arange(len(reqs)), [len(x.questions) for x in reqs])
+    q_idx = questions.get_indexer([q for x in reqs for q in x.questions])
+    req_matrix = np.zeros((len(reqs), len(questions)), dtype=np.int32)
+    np.add.at(req_matrix, (row_idx, q_idx), 1)
+
+    ratio_required = np.array([x.n_required / len(x.questions) for x in reqs], dtype=np.float64)
+
+    # a (modality, standard) pair listed more than once is determined by its last row
+    pairs = pd.DataFrame({'modality': [x.modality for x in reqs], 'standard': [x.standard for x in reqs]})
+    columns = pd.MultiIndex.from_frame(pairs.drop_duplicates())
+    row_col = columns.get_indexer(pd.MultiIndex.from_frame(pairs))
+    col_rows = pd.Series(np.arange(len(row_col))).groupby(row_col).last().to_numpy()
+
+    return CompiledStandards(columns=columns,
+                             questions=questions,
+                             req_matrix=req_matrix,
+                             reqs=np.array([x.reqs for x in reqs], dtype=object),
+                             ratio_required=ratio_required,
+                             col_rows=col_rows)
+
+
+@dataclass
+class ScorePartition:
+    '''
+    Score rows reduced to the fields the grader needs and grouped by student.
+
+    The rows of ``students[i]`` are at positions ``offsets[i]:offsets[i + 1]`` of the row arrays.
+    '''
+    students: pd.Index
+    offsets: np.ndarray  # n_students + 1 row offsets
+    q_code: np.ndarray  # int32 position of each row's score key in CompiledStandards.questions
+    correct: np.ndarray  # int8 ScoreStore.correct codes
+    ungraded: np.ndarray  # bool: is_graded == False
+
+
+_ROW_FIELDS = ('offsets', 'q_code', 'correct', 'ungraded')
+
+
+def _score_rows(scores, students: pd.Index, compiled: CompiledStandards):
+    ''' Student code, question code, correct code and ungraded flag of every score row that can affect grading '''
+    if isinstance(scores, pd.DataFrame):
+        scores = ScoreStore.from_frame(scores)
+
+    # translate the store's dictionaries once instead of looking up every row
+    stu_code = students.get_indexer(scores.students)[scores.stu]
+    q_code = compiled.questions.get_indexer(scores.questions)[scores.q]
+    keep = (stu_code >= 0) & (q_code >= 0)
+
+    return stu_code[keep], q_code[keep], scores.correct[keep], scores.graded[keep] == UNGRADED
+
+
+def partition_scores(scores: ScoreStore, students, compiled: CompiledStandards) -> ScorePartition:
+    '''
+    Group score rows by student with a single sort, keeping only rows that can affect grading.
+
+    :param scores: ScoreStore, or long-format scores with columns ['login_name', 'score_key', 'correct'] and optionally 'is_graded'
+    :param students: login names to grade, in output order
+    :param compiled: compiled learning standards from compile_standards
+    :return: ScorePartition
+    '''
+    students = pd.Index(students)
+    stu_code, q_code, correct, ungraded = _score_rows(scores, students, compiled)
+
+    order = np.argsort(stu_code, kind='stable')
+    offsets = np.zeros(len(students) + 1, dtype=np.int64)
+    np.cumsum(np.bincount(stu_code, minlength=len(students)), out=offsets[1:])
+
+    return ScorePartition(students=students,
+                          offsets=offsets,
+                          q_code=q_code[order].astype(np.int32),
+                          correct=correct[order],
+                          ungraded=ungraded[order])
+
+
+def _achieved_matrix(partition: ScorePartition, compiled: CompiledStandards, lo: int, hi: int) -> np.ndarray:
+    ''' 1/0/NaN achievement of students lo:hi on every output column, see grade_partition '''
+    n_students, n_questions = hi - lo, len(compiled.questions)
+
+    # pivot this block's score rows into student x question flags
+    rows = slice(partition.offsets[lo], partition.offsets[hi])
+    stu_local = np.repeat(np.arange(n_students), np.diff(partition.offsets[lo:hi + 1]))
+    cell = stu_local * n_questions + partition.q_code[rows]
+    correct = partition.correct[rows]
+
+    n_rows = np.bincount(cell, minlength=n_students * n_questions)
+    row_correct = np.where(correct < 0, n_rows[cell] == 1, correct > 0)
+
+    is_correct = np.zeros(n_students * n_questions, dtype=bool)
+    is_correct[cell[row_correct]] = True
+
+    is_graded = np.ones(n_students * n_questions, dtype=bool)
+    is_graded[cell[partition.ungraded[rows]]] = False
+
+    # count graded and correct questions for each requirement row
+    req_t = compiled.req_matrix.T.astype(np.float32)
+    n_graded = (is_graded.reshape(n_students, n_questions).astype(np.float32) @ req_t).astype(np.float64)
+    n_correct = (is_correct.reshape(n_students, n_questions).astype(np.float32) @ req_t).astype(np.float64)
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        achieved = (n_correct >= 1) & (n_correct / n_graded >= compiled.ratio_required)
+    achieved = np.where(n_graded == 0, np.nan, achieved.astype(np.float64))
+
+    return achieved[:, compiled.col_rows]
+
+
+def grade_partition(partition: ScorePartition, compiled: CompiledStandards, lo: int = 0, hi: Optional[int] = None) -> pd.DataFrame:
+    '''
+    Evaluate every learning standard for the students ``lo:hi`` of a partition at once.
+
+    A question counts as graded for a student unless one of their score rows for it has
+    ``is_graded == False``, and as correct if any of their rows for it is truthy. A lone missing
+    ``correct`` value counts as correct, while missing values among repeated rows are ignored.
+    A standard is not tested (NaN) when none of its questions are graded, and achieved (1) when at
+    least one question is correct and the ratio of correct to graded questions meets its threshold.
+
+    :param partition: scores grouped by student from partition_scores
+    :param compiled: compiled learning standards the partition was built against
+    :param lo: first student to grade
+    :param hi: one past the last student to grade, defaults to all remaining students
+    :return: DataFrame of 1/0/NaN with one row per student and (modality, standard) columns
+    '''
+    hi = len(partition.students) if hi is None else hi
+
+    return pd.DataFrame(_achieved_matrix(partition, compiled, lo, hi),
+                        index=partition.students[lo:hi],
+                        columns=compiled.columns)
+
+
+def grade_students(scores: pd.DataFrame, students, compiled: CompiledStandards) -> pd.DataFrame:
+    '''
+    Evaluate every learning standard for a group of students at once. See grade_partition.
+
+    :param scores: long-format scores with columns ['login_name', 'score_key', 'correct'] and optionally 'is_graded'
+    :param students: login names to grade, in output order
+    :param compiled: compiled learning standards from compile_standards
+    :return: DataFrame of 1/0/NaN with one row per student and (modality, standard) columns
+    '''
+    return grade_partition(partition_scores(scores, students, compiled), compiled)
+
+
+def partition_batches(scores: ScoreStore, students, compiled: CompiledStandards, batch_size: int):
+    '''
+    Partition the score rows of consecutive batches of students, one batch at a time.
+
+    Each batch's rows are picked out of the store with one scan of its student codes, so only one
+    batch's partition is held in memory at a time.
+
+    :param scores: ScoreStore of every score row
+    :param students: login names to grade, in output order
+    :param compiled: compiled learning standards from compile_standards
+    :param batch_size: number of students per batch
+    :return: generator of ScorePartition, one per batch of up to batch_size students
+    '''
+    students = pd.Index(students)
+
+    # batch of each of the store's student codes, -1 for students that are not graded
+    code_batch = students.get_indexer(scores.students)
+    code_batch = np.where(code_batch >= 0, code_batch // batch_size, -1).astype(np.int32)
+
+    for bi, lo in enumerate(range(0, len(students), batch_size)):
+        rows = np.flatnonzero(code_batch[scores.stu] == bi)
+        yield partition_scores(scores.take(rows), students[lo:lo + batch_size], compiled)
+
+
+#######################################################################
+# Parallel grading over shared memory
+
+def share_partition(partition: ScorePartition):
+    '''
+    Copy the row arrays of a partition into shared memory blocks.
+
+    :param partition: scores grouped by student
+    :return: (list of SharedMemory blocks, which the caller must close and unlink, and a picklable descriptor for attach_partition)
+    '''
+    blocks = []
+    descriptor = {'students': partition.students}
+
+    for field in _ROW_FIELDS:
+        arr = getattr(partition, field)
+        shm = shared_memory.SharedMemory(create=True, size=max(arr.nbytes, 1))
+        np.ndarray(arr.shape, dtype=arr.dtype, buffer=shm.buf)[:] = arr
+        blocks.append(shm)
+        descriptor[field] = (shm.name, arr.dtype.str, arr.shape)
+
+    return blocks, descriptor
+
+
+def attach_partition(descriptor: dict):
+    '''
+    Map a partition shared by share_partition without copying it.
+
+    :param descriptor: descriptor returned by share_partition
+    :return: (list of attached SharedMemory blocks, which must outlive the partition, and the ScorePartition)
+    '''
+    blocks = []
+    arrays = {}
+
+    for field in _ROW_FIELDS:
+        name, dtype, shape = descriptor[field]
+        # pool workers share the creating process' resource tracker, which only unlinks the block
+        # once, so attaching here needs no unregistering
+        shm = shared_memory.SharedMemory(name=name)
+        blocks.append(shm)
+        arrays[field] = np.ndarray(shape, dtype=np.dtype(dtype), buffer=shm.buf)
+
+    return blocks, ScorePartition(students=descriptor['students'], **arrays)
+
+
+_worker_blocks = None
+_worker_partition = None
+_worker_compiled = None
+
+
+def _init_worker(descriptor: dict, compiled: CompiledStandards):
+    ''' Install the shared partition and the compiled standards once per worker process '''
+    global _worker_blocks, _worker_partition, _worker_compiled
+    _worker_blocks, _worker_partition = attach_partition(descriptor)
+    _worker_compiled = compiled
+
+
+def _grade_block(block) -> np.ndarray:
+    lo, hi = block
+    return _achieved_matrix(_worker_partition, _worker_compiled, lo, hi)
+
+
+def grade_parallel(partition: ScorePartition, compiled: CompiledStandards, nworkers: int, block_size: int) -> pd.DataFrame:
+    '''
+    Evaluate every learning standard for all students in a partition using a pool of processes.
+
+    Workers read their contiguous block of students directly from shared memory and receive the
+    compiled standards once when they start (inherited without pickling where processes are forked),
+    so each task is just a pair of offsets and each result a bare array.
+
+    :param partition: scores grouped by student from partition_scores
+    :param compiled: compiled learning standards the partition was built against
+    :param nworkers: number of worker processes
+    :param block_size: number of students graded per task
+    :return: DataFrame of 1/0/NaN with one row per student and (modality, standard) columns
+    '''
+    n_students = len(partition.students)
+    blocks = [(lo, min(lo + block_size, n_students)) for lo in range(0, n_students, block_size)]
+
+    if nworkers <= 1 or len(blocks) <= 1:
+        return grade_partition(partition, compiled)
+
+    from tqdm import tqdm
+
+    ctx = mp.get_context('fork') if 'fork' in mp.get_all_start_methods() else mp.get_context()
+    shm_blocks, descriptor = share_partition(partition)
+    try:
+        with ctx.Pool(min(nworkers, len(blocks)), initializer=_init_worker, initargs=(descriptor, compiled)) as p:
+            results = list(tqdm(p.imap(_grade_block, blocks),
+                                total=len(blocks),
+                                desc='Evaluating learning standards by student block'))
+    finally:
+        for shm in shm_blocks:
+            shm.close()
+            shm.unlink()
+
+    return pd.DataFrame(np.concatenate(results, axis=0), index=partition.students, columns=compiled.columns)
+
+
+#######################################################################
+# Incremental regrading
+
+@dataclass
+class GradingState:
+    '''
+    Everything needed to tell which parts of a standards_achieved table are out of date.
+    '''
+    achieved: pd.DataFrame  # graded table, one row per student and (modality, standard) columns
+    column_reqs: pd.Series  # requirement string behind each (modality, standard) column
+    student_fp: pd.Series  # fingerprint of each student's score rows
+    question_fp: pd.Series  # fingerprint of each question's score rows
+
+
+def select_columns(compiled: CompiledStandards, columns: pd.MultiIndex) -> CompiledStandards:
+    '''
+    Restrict compiled standards to some of their output columns, keeping the same question order so
+    that partitions built against the full standards remain valid.
+
+    :param compiled: compiled learning standards
+    :param columns: subset of compiled.columns
+    :return: CompiledStandards
+    '''
+    rows = compiled.col_rows[compiled.columns.get_indexer(columns)]
+
+    return CompiledStandards(columns=columns,
+                             questions=compiled.questions,
+                             req_matrix=compiled.req_matrix[rows],
+                             reqs=compiled.reqs[rows],
+                             ratio_required=compiled.ratio_required[rows],
+                             col_rows=np.arange(len(rows)))
+
+
+def score_fingerprints(scores: ScoreStore, students, compiled: CompiledStandards):
+    '''
+    Order-independent fingerprints of the score rows that can affect grading, per student and per question.
+
+    :param scores: ScoreStore, or long-format scores as for partition_scores
+    :param students: login names being graded
+    :param compiled: compiled learning standards
+    :return: (Series of uint64 indexed by student, Series of uint64 indexed by question)
+    '''
+    students = pd.Index(students)
+    stu_code, q_code, correct, ungraded = _score_rows(scores, students, compiled)
+
+    # sum of row hashes, so that repeated rows are counted but row order is not
+    row_hash = pd.util.hash_pandas_object(pd.DataFrame({
+        'login_name': students.to_numpy()[stu_code],
+        'score_key': compiled.questions.to_numpy()[q_code],
+        'correct': correct,
+        'ungraded': ungraded,
+    }), index=False).to_numpy()
+
+    student_fp = np.zeros(len(students), dtype=np.uint64)
+    np.add.at(student_fp, stu_code, row_hash)
+    question_fp = np.zeros(len(compiled.questions), dtype=np.uint64)
+    np.add.at(question_fp, q_code, row_hash)
+
+    return pd.Series(student_fp, index=students), pd.Series(question_fp, index=compiled.questions)
+
+
+def grade_incremental(scores: ScoreStore, students, compiled: CompiledStandards, previous: Optional[GradingState],
+                      nworkers: int, block_size: int):
+    '''
+    Evaluate learning standards, reusing a previous result wherever its inputs are unchanged.
+
+    Students without a previous result are graded on every standard, and standards whose requirements
+    changed are graded for every student. Otherwise a student is only regraded on the standards that
+    reference a question whose score rows changed, and only if their own score rows changed.
+
+    :param scores: ScoreStore of every score row
+    :param students: login names to grade, in output order
+    :param compiled: compiled learning standards from compile_standards
+    :param previous: state saved from the previous run, or None to grade everything
+    :param nworkers: number of worker processes
+    :param block_size: number of students graded per task
+    :return: (DataFrame of 1/0/NaN, GradingState for the next run, number of students regraded, number of standards regraded)
+    '''
+    students = pd.Index(students)
+    student_fp, question_fp = score_fingerprints(scores, students, compiled)
+    column_reqs = pd.Series(compiled.reqs[compiled.col_rows], index=compiled.columns)
+
+    def grade(these_students, these_columns):
+        partition = partition_scores(scores, these_students, compiled)
+        return grade_parallel(partition, select_columns(compiled, these_columns), nworkers, block_size)
+
+    if previous is None:
+        achieved = grade(students, compiled.columns)
+        n_students, n_columns = len(students), len(compiled.columns)
+
+    else:
+        new_students = ~students.isin(previous.achieved.index)
+        changed_students = new_students | (student_fp != previous.student_fp.reindex(students, fill_value=0)).to_numpy()
+
+        redefined = (column_reqs != previous.column_reqs.reindex(compiled.columns)).to_numpy()
+        changed_q = (question_fp != previous.question_fp.reindex(compiled.questions, fill_value=0)).to_numpy()
+        touched = redefined | (compiled.req_matrix[compiled.col_rows][:, changed_q].sum(axis=1) > 0)
+
+        achieved = previous.achieved.reindex(index=students, columns=compiled.columns)
+        for rows, cols in [(new_students, np.ones(len(compiled.columns), dtype=bool)),
+                           (np.ones(len(students), dtype=bool), redefined),
+                           (changed_students & ~new_students, touched & ~redefined)]:
+            if rows.any() and cols.any():
+                achieved.loc[students[rows], compiled.columns[cols]] = grade(students[rows], compiled.columns[cols])
+
+        n_students = int((changed_students | redefined.any()).sum())
+        n_columns = int((touched | new_students.any()).sum())
+
+    state = GradingState(achieved=achieved.copy(), column_reqs=column_reqs, student_fp=student_fp, question_fp=question_fp)
+    return achieved, state, n_students, n_columns
+
+
+#######################################################################
+# Policy sweeps
+
+@dataclass
+class CompiledPolicies:
+    '''
+    Several variants of the grading sheet compiled together, so that they can be graded in one pass.
+
+    Output column ``j`` of ``compiled`` is one distinct requirement (questions and threshold), shared
+    by every policy and standard that has it; ``positions[name]`` maps each column of policy ``name``
+    to it.
+    '''
+    compiled: CompiledStandards  # one output column per distinct requirement of any policy
+    columns: dict  # policy name -> (modality, standard) columns of that policy's standards_achieved table
+    positions: dict  # policy name -> position of each of those columns in compiled.columns
+
+
+def compile_policies(policies: dict) -> CompiledPolicies:
+    '''
+    Compile several grading policies into one requirement matrix.
+
+    :param policies: dict of policy name -> RequirementTable
+    :return: CompiledPolicies
+    '''
+    distinct = {}  # requirement string -> Requirement
+    columns, positions = {}, {}
+
+    for name, table in policies.items():
+        compiled = compile_standards(table)
+        for ri in compiled.col_rows:
+            distinct.setdefault(table.requirements[ri].reqs, table.requirements[ri])
+
+        order = {x: i for i, x in enumerate(distinct)}
+        columns[name] = compiled.columns
+        positions[name] = np.array([order[x] for x in compiled.reqs[compiled.col_rows]], dtype=np.int64)
+
+    # the requirement string stands in for the standard, so that every distinct requirement is its own column
+    merged = RequirementTable.from_requirements([Requirement(reqs, 'policy', x.n_required, x.questions)
+                                                 for reqs, x in distinct.items()])
+
+    return CompiledPolicies(compiled=compile_standards(merged), columns=columns, positions=positions)
+
+
+def sweep_policies(partitions, policies: CompiledPolicies, nworkers: int, block_size: int) -> pd.DataFrame:
+    '''
+    Achievement rate of every standard under every policy, from running sums over batches of students.
+
+    The rate of a standard is the fraction of the students it was tested for who achieved it. The
+    ``fraction_achieved`` rows are the mean over students of each student's fraction of the modality's
+    standards achieved, as in standards_achieved.
+
+    :param partitions: iterable of ScorePartition built against policies.compiled, e.g. from partition_batches
+    :param policies: compiled policies from compile_policies
+    :param nworkers: number of worker processes
+    :param block_size: number of students graded per task
+    :return: DataFrame indexed by (modality, standard) and ('fraction_achieved', modality), with (policy, 'reqs'/'rate'/'tested') columns
+    '''
+    n_columns = len(policies.compiled.columns)
+    achieved_sum = np.zeros(n_columns)
+    tested = np.zeros(n_columns, dtype=np.int64)
+    modality_columns = {(name, m): policies.positions[name][(columns.get_level_values('modality') == m)]
+                        for name, columns in policies.columns.items()
+                        for m in columns.get_level_values('modality').unique()}
+    fraction_sum = dict.fromkeys(modality_columns, 0.0)
+    fraction_count = dict.fromkeys(modality_columns, 0)
+
+    for partition in partitions:
+        achieved = grade_parallel(partition, policies.compiled, nworkers, block_size).to_numpy()
+        is_tested = ~np.isnan(achieved)
+        achieved = np.where(is_tested, achieved, 0)
+
+        achieved_sum += achieved.sum(axis=0)
+        tested += is_tested.sum(axis=0)
+        for key, pos in modality_columns.items():
+            n_tested = is_tested[:, pos].sum(axis=1)
+            fraction_sum[key] += (achieved[:, pos].sum(axis=1)[n_tested > 0] / n_tested[n_tested > 0]).sum()
+            fraction_count[key] += int((n_tested > 0).sum())
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        rate = np.where(tested > 0, achieved_sum / tested, np.nan)
+
+    reqs = policies.compiled.columns.get_level_values('standard')
+    index = pd.MultiIndex.from_tuples(list(dict.fromkeys(x for columns in policies.columns.values() for x in columns)) +
+                                      [('fraction_achieved', m) for m in dict.fromkeys(m for _, m in modality_columns)],
+                                      names=['modality', 'standard'])
+
+    table = {}
+    for name, columns in policies.columns.items():
+        pos = policies.positions[name]
+        fractions = pd.Series({('fraction_achieved', m): fraction_sum[(n, m)] / max(fraction_count[(n, m)], 1)
+                               for n, m in modality_columns if n == name}, dtype=np.float64)
+        counts = pd.Series({('fraction_achieved', m): fraction_count[(n, m)] for n, m in modality_columns if n == name},
+                           dtype=np.int64)
+
+        table[(name, 'reqs')] = pd.Series(reqs[pos], index=columns).reindex(index)
+        table[(name, 'rate')] = pd.concat([pd.Series(rate[pos], index=columns), fractions]).reindex(index)
+        table[(name, 'tested')] = pd.concat([pd.Series(tested[pos], index=columns), counts]).reindex(index)
+
+    return pd.DataFrame(table, index=index)
@@ -0,0 +1,228 @@
+# # Output files
+#
+# MAT188 2023F at the University of Toronto
+
+# %%
+from typing import Optional
+import importlib.util
+import os
+import os.path
+
+import pandas as pd
+
+# output format -> file extension
+FORMATS = {'csv': 'csv', 'parquet': 'parquet', 'feather': 'feather'}
+
+
+def require_format(fmt: str):
+    ''' Fail early if an output format is unknown or needs pyarrow and it is not installed '''
+    if fmt not in FORMATS:
+        raise ValueError(f'Unknown output format: {fmt}')
+
+    if fmt != 'csv' and importlib.util.find_spec('pyarrow') is None:
+        raise ImportError(f'Writing {fmt} files requires pyarrow (pip install pyarrow)')
+
+
+def achieved_path(output_path: str, fmt: str) -> str:
+    return f'{output_path}/standards_achieved.{FORMATS[fmt]}'
+
+
+def write_achieved(standards_achieved: pd.DataFrame, output_path: str, fmt: str = 'csv'):
+    '''
+    Write the standards_achieved table, replacing any previous file of the same format atomically.
+
+    Parquet and Feather keep the (group, name) column MultiIndex, NaN and the column dtypes as they are;
+    CSV stores them as a two-row header and text.
+
+    :param standards_achieved: table with one row per student and two-level columns
+    :param output_path: output directory
+    :param fmt: one of FORMATS
+    '''
+    path = achieved_path(output_path, fmt)
+    tmp_path = f'{path}.tmp'
+
+    if fmt == 'csv':
+        standards_achieved.to_csv(tmp_path)
+    elif fmt == 'parquet':
+        standards_achieved.to_parquet(tmp_path)
+    elif fmt == 'feather':
+        standards_achieved.to_feather(tmp_path)
+
+    os.replace(tmp_path, path)
+
+
+def write_achieved_batches(batches, output_path: str, fmt: str = 'csv') -> int:
+    '''
+    Write the standards_achieved table one batch of students at a time, as written by write_achieved.
+
+    Only one batch is held in memory at a time. Every batch must have the same columns, in the same order.
+
+    :param batches: iterable of DataFrames with one row per student and two-level columns
+    :param output_path: output directory
+    :param fmt: one of FORMATS
+    :return: number of rows written
+    '''
+    path = achieved_path(output_path, fmt)
+    tmp_path = f'{path}.tmp'
+    n_rows = 0
+
+    if fmt == 'csv':
+        with open(tmp_path, 'w', newline='') as f:
+            for batch in batches:
+                batch.to_csv(f, header=n_rows == 0)
+                n_rows += len(batch)
+
+    else:
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+
+        writer = None
+        try:
+            for batch in batches:
+                if writer is None:
+                    # the first batch fixes the schema, including the pandas metadata that restores the columns
+                    table = pa.Table.from_pandas(batch)
+                    schema = table.schema
+                    writer = pq.ParquetWriter(tmp_path, schema) if fmt == 'parquet' else pa.ipc.new_file(tmp_path, schema)
+                else:
+                    table = pa.Table.from_pandas(batch).cast(schema)
+                writer.write_table(table)
+                n_rows += len(batch)
+        finally:
+            if writer is not None:
+                writer.close()
+
+        if writer is None:
+            raise ValueError(f'No students to write to {path}')
+
+    os.replace(tmp_path, path)
+    return n_rows
+
+
+def read_achieved(output_path: str, fmt: Optional[str] = None) -> pd.DataFrame:
+    '''
+    Read the standards_achieved table written by write_achieved.
+
+    :param output_path: output directory
+    :param fmt: one of FORMATS, or None to read the most recently written format
+    :return: DataFrame with one row per student and two-level columns
+    '''
+    if fmt is None:
+        written = [x for x in FORMATS if os.path.exists(achieved_path(output_path, x))]
+        if not written:
+            raise FileNotFoundError(f'No standards_achieved file in {output_path}')
+        fmt = max(written, key=lambda x: os.path.getmtime(achieved_path(output_path, x)))
+
+    path = achieved_path(output_path, fmt)
+    if fmt == 'csv':
+        return pd.read_csv(path, header=[0, 1], index_col=0)
+    elif fmt == 'parquet':
+        return pd.read_parquet(path)
+    elif fmt == 'feather':
+        return pd.read_feather(path)
+
+    raise ValueError(f'Unknown output format: {fmt}')
+
+
+def write_scores(scores, output_path: str, fmt: str = 'csv', chunk_rows: int = 1 << 20) -> str:
+    '''
+    Dump every row of a score store for debugging, decoding and writing chunk_rows rows at a time.
+
+    :param scores: ScoreStore
+    :param output_path: output directory
+    :param fmt: one of FORMATS
+    :param chunk_rows: number of rows decoded at once
+    :return: path of the written file
+    '''
+    path = f'{output_path}/debug_raw_scores.{FORMATS[fmt]}'
+    tmp_path = f'{path}.tmp'
+
+    # plain strings, so that every chunk has the same schema
+    chunks = (x.astype({'login_name': str, 'score_key': str}) for x in scores.iter_frames(chunk_rows))
+
+    if fmt == 'csv':
+        with open(tmp_path, 'w', newline='') as f:
+            for ci, chunk in enumerate(chunks):
+                chunk.to_csv(f, header=ci == 0)
+
+    else:
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+
+        schema = pa.schema([('login_name', pa.string()), ('score_key', pa.string()), ('correct', pa.float64()),
+                            ('is_graded', pa.bool_()), ('score', pa.float32()), ('n_incor', pa.int16())])
+        writer = pq.ParquetWriter(tmp_path, schema) if fmt == 'parquet' else pa.ipc.new_file(tmp_path, schema)
+        with writer:
+            for chunk in chunks:
+                writer.write_table(pa.Table.from_pandas(chunk, schema=schema, preserve_index=False))
+
+    os.replace(tmp_path, path)
+    return path
+
+
+def cube_format(fmt: str) -> str:
+    ''' Format of the analytics cube: fmt, or parquet instead of csv when pyarrow is installed '''
+    if fmt == 'csv' and importlib.util.find_spec('pyarrow') is not None:
+        return 'parquet'
+    return fmt
+
+
+def cube_path(output_path: str, name: str, fmt: str) -> str:
+    return f'{output_path}/analytics_{name}.{FORMATS[fmt]}'
+
+
+def write_cube(cube: dict, output_path: str, fmt: str = 'csv') -> dict:
+    '''
+    Write the tables of the analytics cube from lscube, replacing previous files atomically.
+
+    Parquet and Feather keep the categorical key columns dictionary-encoded, so the files stay small
+    and load without parsing; CSV is only used when pyarrow is not installed.
+
+    :param cube: {name: long-format DataFrame}
+    :param output_path: output directory
+    :param fmt: one of FORMATS, passed through cube_format
+    :return: {name: path of the written file}
+    '''
+    fmt = cube_format(fmt)
+    paths = {}
+    for name, frame in cube.items():
+        path = cube_path(output_path, name, fmt)
+        tmp_path = f'{path}.tmp'
+
+        if fmt == 'csv':
+            frame.to_csv(tmp_path, index=False)
+        elif fmt == 'parquet':
+            frame.to_parquet(tmp_path, index=False)
+        elif fmt == 'feather':
+            frame.to_feather(tmp_path)
+
+        os.replace(tmp_path, path)
+        paths[name] = path
+
+    return paths
+
+
+def read_cube(output_path: str, name: str, fmt: Optional[str] = None) -> pd.DataFrame:
+    '''
+    Read a table of the analytics cube written by write_cube.
+
+    :param output_path: output directory
+    :param name: table name, e.g. 'standards' or 'questions'
+    :param fmt: one of FORMATS, or None to read the most recently written format
+    :return: long-format DataFrame
+    '''
+    if fmt is None:
+        written = [x for x in FORMATS if os.path.exists(cube_path(output_path, name, x))]
+        if not written:
+            raise FileNotFoundError(f'No analytics_{name} file in {output_path}')
+        fmt = max(written, key=lambda x: os.path.getmtime(cube_path(output_path, name, x)))
+
+    path = cube_path(output_path, name, fmt)
+    if fmt == 'csv':
+        return pd.read_csv(path)
+    elif fmt == 'parquet':
+        return pd.read_parquet(path)
+    elif fmt == 'feather':
+        return pd.read_feather(path)
+
+    raise ValueError(f'Unknown output format: {fmt}')
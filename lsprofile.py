@@ -0,0 +1,156 @@
+# # Stage timing and profiling
+#
+# MAT188 2023F at the University of Toronto
+
+# %%
+from typing import Optional
+import contextlib
+import itertools
+import cProfile
+import json
+import os
+import os.path
+import threading
+import time
+
+_enabled = False
+_cprofile_dir = None
+_events = []
+_local = threading.local()
+_dump_ids = itertools.count()
+
+
+def enable(cprofile_dir: Optional[str] = None):
+    '''
+    Start recording stages.
+
+    :param cprofile_dir: directory to dump a cProfile of every outermost stage of the main thread to, or None to skip cProfile
+    '''
+    global _enabled, _cprofile_dir
+    _enabled = True
+    _cprofile_dir = cprofile_dir
+    if cprofile_dir is not None:
+        os.makedirs(cprofile_dir, exist_ok=True)
+
+
+def enabled() -> bool:
+    return _enabled
+
+
+def config() -> dict:
+    ''' Settings to pass to init_worker so that pool workers record stages the same way '''
+    return {'enabled': _enabled, 'cprofile_dir': _cprofile_dir}
+
+
+def init_worker(settings: dict):
+    ''' Pool initializer: apply config() from the parent and forget any stages inherited by fork '''
+    del _events[:]
+    _local.depth = 0
+    if settings['enabled']:
+        enable(settings['cprofile_dir'])
+
+
+@contextlib.contextmanager
+def stage(name: str, **args):
+    '''
+    Record the wall time, process CPU time and RSS change of a block of code.
+
+    The yielded dict can be updated inside the block, e.g. with the number of ``rows`` processed.
+    Does nothing unless enable() has been called.
+
+    :param name: stage name, stages with the same name are aggregated in the summary
+    :param args: extra values to record with this occurrence, e.g. the file being parsed
+    '''
+    record = dict(args)
+    if not _enabled:
+        yield record
+        return
+
+    depth = getattr(_local, 'depth', 0)
+    profile = None
+    if _cprofile_dir is not None and depth == 0 and threading.current_thread() is threading.main_thread():
+        profile = cProfile.Profile()
+
+    import psutil
+
+    process = psutil.Process()
+    rss = process.memory_info().rss
+    cpu = time.process_time()
+    t1 = time.time()
+
+    _local.depth = depth + 1
+    if profile is not None:
+        profile.enable()
+    try:
+        yield record
+    finally:
+        if profile is not None:
+            profile.disable()
+        _local.depth = depth
+
+        _events.append({
+            'name': name,
+            'ts': t1 * 1e6,
+            'dur': (time.time() - t1) * 1e6,
+            'cpu': time.process_time() - cpu,
+            'rss_delta': process.memory_info().rss - rss,
+            'depth': depth,
+            'pid': os.getpid(),
+            'tid': threading.get_ident(),
+            'args': record,
+        })
+
+        if profile is not None:
+            profile.dump_stats(os.path.join(_cprofile_dir, f'{name}-{os.getpid()}-{next(_dump_ids)}.prof'))
+
+
+def drain() -> list:
+    ''' Remove and return the stages recorded in this process, e.g. to send them from a worker to its parent '''
+    events = _events.copy()
+    del _events[:len(events)]
+    return events
+
+
+def extend(events: list):
+    ''' Add stages recorded in another process, nesting them under the stage that is open in this thread '''
+    depth = getattr(_local, 'depth', 0)
+    _events.extend(dict(x, depth=x['depth'] + depth) for x in events)
+
+
+def summary() -> str:
+    ''' Table of the recorded stages, aggregated by name in order of first occurrence '''
+    totals = {}
+    for ev in sorted(_events, key=lambda x: x['ts']):
+        total = totals.setdefault(ev['name'], {'depth': ev['depth'], 'calls': 0, 'wall': 0.0, 'cpu': 0.0, 'rows': 0,
+                                               'rss_delta': 0})
+        total['depth'] = min(total['depth'], ev['depth'])
+        total['calls'] += 1
+        total['wall'] += ev['dur'] / 1e6
+        total['cpu'] += ev['cpu']
+        total['rows'] += ev['args'].get('rows', 0)
+        total['rss_delta'] += ev['rss_delta']
+
+    lines = [f'{"stage":40s} {"calls":>6s} {"wall s":>9s} {"cpu s":>9s} {"rows":>11s} {"RSS +MB":>9s}']
+    for name, total in totals.items():
+        label = '  ' * total['depth'] + name
+        lines.append(f'{label:40s} {total["calls"]:6d} {total["wall"]:9.3f} {total["cpu"]:9.3f} '
+                     f'{total["rows"]:11d} {total["rss_delta"] / 2**20:9.1f}')
+
+    return '\n'.join(lines)
+
+
+def write_trace(path: str):
+    ''' Write the recorded stages as a Chrome trace (chrome://tracing, Perfetto) '''
+    trace = [{
+        'name': ev['name'],
+        'ph': 'X',
+        'ts': ev['ts'],
+        'dur': ev['dur'],
+        'pid': ev['pid'],
+        'tid': ev['tid'],
+        'args': dict(ev['args'], cpu_s=ev['cpu'], rss_delta_mb=ev['rss_delta'] / 2**20),
+    } for ev in _events]
+
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    with open(path, 'w') as f:
+        json.dump({'traceEvents': trace, 'displayTimeUnit': 'ms'}, f)
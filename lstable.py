@@ -0,0 +1,232 @@
+# # Lookup table checks
+#
+# MAT188 2023F at the University of Toronto
+#
+# Checks the learning standards lookup table before a grading run. Only the standard library is
+# used: the workbook is read straight from its XML parts, so that `lscli check-table` answers
+# without loading pandas or openpyxl.
+
+# %%
+import posixpath
+import re
+import zipfile
+import xml.etree.ElementTree as ET
+
+NS = {'main': 'http://schemas.openxmlformats.org/spreadsheetml/2006/main',
+      'rel': 'http://schemas.openxmlformats.org/package/2006/relationships'}
+REL_ID = '{http://schemas.openxmlformats.org/officeDocument/2006/relationships}id'
+
+# tutorial score keys, e.g. tut3-2-b for week 3, SBG 2, part b
+TUT_KEY_RE = re.compile(r'tut(\d+)\-(\d+)\-\w+')
+
+CELL_REF_RE = re.compile(r'([A-Z]+)(\d+)')
+
+
+def split_requirement(reqs: str):
+    '''
+    Split a requirement string of the lookup table, e.g. '2|ww1-1,ww1-2,ww2-4' or 'ww1-1,ww1-2'.
+
+    :param reqs: requirement string
+    :return: (number of questions that must be correct, or None if all of them, tuple of score keys)
+    '''
+    n_required = None
+    if '|' in reqs:
+        n_required, reqs = reqs.split('|')[0:2]
+        n_required = int(n_required)
+
+    return n_required, tuple(x.strip() for x in reqs.split(','))
+
+
+def _column_index(letters: str) -> int:
+    ci = 0
+    for x in letters:
+        ci = ci * 26 + ord(x) - ord('A') + 1
+    return ci - 1
+
+
+def _cell_value(cell: ET.Element, shared_strings: list):
+    kind = cell.get('t', 'n')
+    if kind == 'inlineStr':
+        text = cell.find('main:is', NS)
+        return None if text is None else ''.join(x.text or '' for x in text.iterfind('.//main:t', NS))
+
+    v = cell.find('main:v', NS)
+    if v is None or v.text is None:
+        return None
+    if kind == 's':
+        return shared_strings[int(v.text)]
+    if kind == 'b':
+        return v.text == '1'
+    if kind in ('str', 'e'):
+        return v.text
+
+    number = float(v.text)
+    return int(number) if number.is_integer() else number
+
+
+def read_sheets(filename: str) -> dict:
+    '''
+    Cell values of every worksheet of an .xlsx workbook.
+
+    :param filename: path to .xlsx file
+    :return: {sheet name: list of row tuples}, where row i of the list is spreadsheet row i + 1 and empty cells are None
+    '''
+    with zipfile.ZipFile(filename) as zf:
+        workbook = ET.fromstring(zf.read('xl/workbook.xml'))
+        rels = ET.fromstring(zf.read('xl/_rels/workbook.xml.rels'))
+        targets = {x.get('Id'): x.get('Target') for x in rels.iterfind('rel:Relationship', NS)}
+
+        shared_strings = []
+        if 'xl/sharedStrings.xml' in zf.namelist():
+            for si in ET.fromstring(zf.read('xl/sharedStrings.xml')).iterfind('main:si', NS):
+                shared_strings.append(''.join(x.text or '' for x in si.iterfind('.//main:t', NS)))
+
+        sheets = {}
+        for sheet in workbook.iterfind('main:sheets/main:sheet', NS):
+            target = targets[sheet.get(REL_ID)]
+            path = target.lstrip('/') if target.startswith('/') else posixpath.normpath(f'xl/{target}')
+
+            rows = []
+            for row in ET.fromstring(zf.read(path)).iterfind('main:sheetData/main:row', NS):
+                values = {}
+                for ci, cell in enumerate(row.iterfind('main:c', NS)):
+                    ref = CELL_REF_RE.match(cell.get('r', ''))
+                    values[_column_index(ref.group(1)) if ref else ci] = _cell_value(cell, shared_strings)
+
+                r = int(row.get('r', len(rows) + 1))
+                rows.extend([()] * (r - 1 - len(rows)))
+                rows.append(tuple(values.get(ci) for ci in range(max(values, default=-1) + 1)))
+
+            sheets[sheet.get('name')] = rows
+
+    return sheets
+
+
+def _column_letter(ci: int) -> str:
+    letters = ''
+    ci += 1
+    while ci:
+        ci, rem = divmod(ci - 1, 26)
+        letters = chr(ord('A') + rem) + letters
+    return letters
+
+
+def _header(rows: list) -> list:
+    return [x.strip() if isinstance(x, str) else x for x in (rows[0] if rows else ())]
+
+
+def check_grading_sheet(name: str, rows: list, weeks: set = None) -> list:
+    '''
+    Problems with a sheet in the format of the grading sheet.
+
+    :param name: sheet name, for messages
+    :param rows: rows from read_sheets
+    :param weeks: tutorial weeks with SBG assignments, or None to not check tutorial keys against them
+    :return: list of messages, empty if the sheet is fine
+    '''
+    header = _header(rows)
+    if 'standard' not in header:
+        return [f'{name}: no standard column in the first row']
+
+    problems = []
+    modalities = [x for x in header if x != 'standard']
+    for x in set(x for x in modalities if modalities.count(x) > 1 or x in (None, '')):
+        problems.append(f'{name}: modality column {x!r} is empty or repeated')
+
+    si = header.index('standard')
+    seen = {}
+    for ri, row in enumerate(rows[1:], start=2):
+        standard = row[si] if si < len(row) else None
+        if standard in (None, ''):
+            if any(x not in (None, '') for x in row):
+                problems.append(f'{name}!{_column_letter(si)}{ri}: requirements without a standard')
+            continue
+        if standard in seen:
+            problems.append(f'{name}!{_column_letter(si)}{ri}: standard {standard} already listed in row {seen[standard]}')
+        seen[standard] = ri
+
+        for ci, modality in enumerate(header):
+            reqs = row[ci] if ci < len(row) else None
+            if ci == si or reqs in (None, ''):
+                continue
+
+            where = f'{name}!{_column_letter(ci)}{ri} ({standard}, {modality})'
+            if not isinstance(reqs, str):
+                problems.append(f'{where}: requirement {reqs!r} is not a list of score keys')
+                continue
+            if reqs.count('|') > 1:
+                problems.append(f'{where}: more than one | in {reqs!r}')
+                continue
+            try:
+                n_required, questions = split_requirement(reqs)
+            except ValueError:
+                problems.append(f'{where}: threshold before | is not a whole number in {reqs!r}')
+                continue
+
+            if '' in questions:
+                problems.append(f'{where}: empty score key in {reqs!r}')
+            elif n_required is not None and not 1 <= n_required <= len(questions):
+                problems.append(f'{where}: threshold {n_required} is not between 1 and the {len(questions)} questions listed')
+
+            if modality == 'tutorial':
+                for q in questions:
+                    m = TUT_KEY_RE.search(q)
+                    if m is None:
+                        problems.append(f'{where}: tutorial score key {q!r} has no week and SBG number')
+                    elif weeks is not None and int(m.group(1)) not in weeks:
+                        problems.append(f'{where}: no SBG is assigned in week {m.group(1)} of {q!r} (sbg_assigned)')
+
+    return problems
+
+
+def check_table(filename: str, sheets: list = ()) -> list:
+    '''
+    Problems with the learning standards lookup table that would fail or silently change a grading run.
+
+    The grading sheet (and any other sheets given) must list unique standards with requirement strings
+    that parse and have thresholds between 1 and their number of questions, tutorial score keys must
+    name a week with SBG assignments, and every day in tut_dates needs a row in sbg_assigned.
+
+    :param filename: path to standards_lookup_table.xlsx
+    :param sheets: other sheets in the format of the grading sheet to check, e.g. policies for `lscli sweep`
+    :return: list of messages, empty if the table is fine
+    '''
+    workbook = read_sheets(filename)
+    missing = [x for x in ['grading', 'tut_dates', 'sbg_assigned'] + list(sheets) if x not in workbook]
+    if missing:
+        return [f'{filename}: missing sheets {", ".join(missing)}']
+
+    problems = []
+
+    # tutorial days and their SBG assignments by week
+    tut_dates = workbook['tut_dates']
+    header = _header(tut_dates)
+    days = set()
+    if 'tutorial' not in header or 'day' not in header:
+        problems.append('tut_dates: no tutorial and day columns in the first row')
+    else:
+        ti, di = header.index('tutorial'), header.index('day')
+        seen = {}
+        for ri, row in enumerate(tut_dates[1:], start=2):
+            tutorial = row[ti] if ti < len(row) else None
+            if tutorial in (None, ''):
+                continue
+            if tutorial in seen:
+                problems.append(f'tut_dates!{_column_letter(ti)}{ri}: tutorial {tutorial} already listed in row {seen[tutorial]}')
+            seen[tutorial] = ri
+            day = row[di] if di < len(row) else None
+            if day in (None, ''):
+                problems.append(f'tut_dates!{_column_letter(di)}{ri}: tutorial {tutorial} has no day')
+            else:
+                days.add(day)
+
+    sbg_assigned = workbook['sbg_assigned']
+    weeks = set(x for x in _header(sbg_assigned)[1:] if isinstance(x, int))
+    assigned_days = set(row[0] for row in sbg_assigned[1:] if row and row[0] not in (None, ''))
+    for day in sorted(days - assigned_days, key=str):
+        problems.append(f'sbg_assigned: no row for tutorial day {day}')
+
+    for name in ['grading'] + list(sheets):
+        problems += check_grading_sheet(name, workbook[name], weeks)
+
+    return problems
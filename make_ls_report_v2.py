@@ -1,69 +1,290 @@
-from typing import Optional
-
 import os
 import os.path
+import re
+import json
+import hashlib
 import subprocess
 import shutil
+import tempfile
 import pandas as pd
+import numpy as np
 import datetime
 import argparse
+import multiprocessing as mp
+from typing import Optional
+from multiprocessing.pool import ThreadPool
 
-from tqdm import tqdm
+import lscli
+import lsdb
+import lsoutput
+import lsprofile
 
 
-def build_tex(row: pd.Series, args: argparse.Namespace, filename: Optional[str] = None, ):
-    filename = filename or row.name
+def compile_template(filename: str) -> list:
+    '''
+    Read a report page template once and split it on its REPL<field>REPL placeholders.
 
-    # row.dropna(inplace=True)
-    subset_cols = row.drop('student', level=0).drop('fraction_achieved', level=0)
+    :param filename: path to the page template
+    :return: list alternating literal text (even positions) and placeholder field names (odd positions)
+    '''
+    with open(filename, "r") as f:
+        return re.split(r'REPL(\w+?)REPL', f.read())
 
 
-    with open("./tex_files/ls_report_page.tex", "r") as f:
-        template = f.read()
+def fill_template(template: list, fields: dict) -> str:
+    ''' Substitute fields into a template from compile_template '''
+    parts = template.copy()
+    parts[1::2] = [fields[x] for x in template[1::2]]
+    return ''.join(parts)
 
-    # make replacements
-    template = template.replace(
-        "REPLfullnameREPL",
-        f"{row[('student', 'first_name')]} {row[('student', 'last_name')]}")
-    template = template.replace("REPLutoridREPL",
-                                str(row[('student', 'student_id')]))
 
-    # build summary table
-    summary_data = subset_cols.groupby(level='modality').agg(
-        ['count', 'sum'])
+def build_pages(student_progress: pd.DataFrame, template: list):
+    '''
+    Build the report page of every student.
 
-    summary_tex = []
-    for modality, (total, achieved) in summary_data.iterrows():
-        summary_tex.append(
-            f'{modality} & {achieved:.0f} & {total:.0f} \\\\ \\midrule')
-    template = template.replace("REPLsummarytableREPL", '\n'.join(summary_tex))
+    The summary and detailed tables are computed for all students at once; only the final string
+    assembly happens per student.
 
-    # build detailed table
-    rows = []
-    for modality, key in subset_cols.index:
-        if row[(modality, key)] == 0:
-            achieved = 'No'
-        elif row[(modality, key)] == 1:
-            achieved = 'Yes'
-        else:
-            achieved = r'\textit{Not tested}'
+    :param student_progress: standards_achieved table with ('student', 'student_id') added
+    :param template: page template from compile_template
+    :return: generator of page strings, in the order of student_progress
+    '''
+    ls_cols = student_progress.columns.drop(['student', 'fraction_achieved'], level=0)
+    values = student_progress[ls_cols].to_numpy(dtype=float)
+    col_modality = ls_cols.get_level_values(0).to_numpy()
+
+    # summary table: standards tested and achieved per modality
+    modalities = sorted(set(col_modality))
+    total = np.stack([(~np.isnan(values[:, col_modality == x])).sum(axis=1) for x in modalities], axis=1)
+    achieved = np.stack([np.nansum(values[:, col_modality == x], axis=1) for x in modalities], axis=1)
+
+    # detailed table: every (standard, outcome) line, picked per student by outcome
+    outcomes = ['No', 'Yes', r'\textit{Not tested}']
+    detail_lines = np.array([[f'\\PulledLS{{{key}}} & {outcome} & {modality} \\\\ \\midrule' for outcome in outcomes]
+                             for modality, key in ls_cols],
+                            dtype=object).reshape(len(ls_cols), len(outcomes))
+    detail_outcome = np.where(values == 0, 0, np.where(values == 1, 1, 2))
+    col_idx = np.arange(len(ls_cols))
+
+    first_names = student_progress[('student', 'first_name')].to_numpy()
+    last_names = student_progress[('student', 'last_name')].to_numpy()
+    student_ids = student_progress[('student', 'student_id')].to_numpy()
+
+    for si in range(len(student_progress)):
+        summary_tex = [f'{modality} & {achieved[si, mi]:.0f} & {total[si, mi]:.0f} \\\\ \\midrule'
+                       for mi, modality in enumerate(modalities)]
 
-        tblrow = f'\\PulledLS{{{key}}} & {achieved} & {modality} \\\\ \\midrule'
-        rows.append(tblrow)
+        yield fill_template(template, {
+            'fullname': f'{first_names[si]} {last_names[si]}',
+            'utorid': str(student_ids[si]),
+            'summarytable': '\n'.join(summary_tex),
+            'detailedtable': '\n'.join(detail_lines[col_idx, detail_outcome[si]]),
+        })
 
-    template = template.replace("REPLdetailedtableREPL", '\n'.join(rows))
 
-    with open(f"{args.output_path}/ls_reports/tex/combined.tex", "a") as f:
-        f.write(template)
+# pdflatex options for unattended builds: never stop for input, stop at the first error
+PDFLATEX_BATCH = ['-interaction=nonstopmode', '-halt-on-error', '-file-line-error']
+
+# sources read while the report header is processed, besides the header itself
+HEADER_SOURCE_DIRS = ['./tex_files', './Learning_Standards']
+HEADER_SOURCE_EXTS = ('.tex', '.sty', '.cls', '.bib')
+
+
+def compile_tex(tex_path: str, output_dir: str, fmt: Optional[str] = None):
+    '''
+    Compile a LaTeX document with pdflatex in batch mode.
+
+    The console output is captured rather than interleaved with that of other builds; pdflatex also
+    writes it to the .log file in output_dir. The end of it is printed if the build fails.
+
+    :param tex_path: path to the .tex file
+    :param output_dir: directory to write the PDF and auxiliary files to
+    :param fmt: precompiled format from build_format (path without .fmt) to load instead of the default one, or None
+    :return: (pdflatex exit code, wall time in seconds)
+    '''
+    cmd = ['pdflatex'] + PDFLATEX_BATCH + ([f'-fmt={fmt}'] if fmt else []) + ['-output-directory', output_dir, tex_path]
+
+    t1 = datetime.datetime.now()
+    with lsprofile.stage('pdflatex', file=os.path.basename(tex_path)):
+        result = subprocess.run(cmd, stdin=subprocess.DEVNULL, stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+                                text=True, errors='replace')
+
+    if result.returncode != 0:
+        tail = '\n'.join(result.stdout.splitlines()[-20:])
+        print(f'pdflatex failed on {tex_path} (exit code {result.returncode}):\n{tail}')
+
+    return result.returncode, (datetime.datetime.now() - t1).total_seconds()
+
+
+def header_sources_hash(header: str) -> str:
+    '''
+    SHA-256 of the report header, every LaTeX source it may read and the pdflatex version.
+
+    :param header: contents of the report header template
+    :return: hex digest
+    '''
+    digest = hashlib.sha256(header.encode())
+
+    version = subprocess.run(['pdflatex', '--version'], stdin=subprocess.DEVNULL, capture_output=True, text=True)
+    digest.update(version.stdout.encode())
+
+    for source_dir in HEADER_SOURCE_DIRS:
+        for root, dirs, files in sorted(os.walk(source_dir)):
+            dirs.sort()
+            for name in sorted(files):
+                if name.endswith(HEADER_SOURCE_EXTS):
+                    path = os.path.join(root, name)
+                    digest.update(path.encode())
+                    with open(path, 'rb') as f:
+                        digest.update(hashlib.sha256(f.read()).digest())
+
+    return digest.hexdigest()
+
+
+def build_format(header: str, fmt_dir: str):
+    '''
+    Dump the preamble of the report header (everything before \\begin{document}) into a pdflatex format.
+
+    The format is keyed by header_sources_hash, so it is only rebuilt when the header, the sources it
+    reads or pdflatex change. Documents compiled with it must start at \\begin{document}.
+
+    :param header: contents of the report header template
+    :param fmt_dir: directory to keep formats in
+    :return: (format path without .fmt for compile_tex, or None if it could not be built, and the hash it is keyed by)
+    '''
+    key = header_sources_hash(header)
+    name = f'ls_header-{key[:16]}'
+    fmt = os.path.join(fmt_dir, name)
+    if os.path.exists(f'{fmt}.fmt'):
+        return fmt, key
+
+    os.makedirs(fmt_dir, exist_ok=True)
+    with open(f'{fmt}.tex', 'w') as f:
+        f.write(header[:header.index('\\begin{document}')] + '\n\\dump\n')
+
+    with lsprofile.stage('dump_format'):
+        result = subprocess.run(['pdflatex', '-ini', f'-jobname={name}'] + PDFLATEX_BATCH +
+                                ['-output-directory', fmt_dir, '&pdflatex', f'{fmt}.tex'],
+                                stdin=subprocess.DEVNULL, stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+                                text=True, errors='replace')
+
+    if result.returncode != 0 or not os.path.exists(f'{fmt}.fmt'):
+        print(f'Could not precompile the report header (see {fmt}.log), compiling it with every report instead')
+        return None, key
+
+    # formats of earlier headers are not needed any more
+    for other in os.listdir(fmt_dir):
+        if other.startswith('ls_header-') and not other.startswith(name):
+            os.remove(os.path.join(fmt_dir, other))
+
+    return fmt, key
+
+
+def merge_pdfs(pdf_paths: list, output_path: str):
+    ''' Concatenate PDFs in order with pdfpages, so that no PDF library is needed beyond pdflatex '''
+    with tempfile.TemporaryDirectory() as tmpdir:
+        with open(f'{tmpdir}/merged.tex', 'w') as f:
+            f.write('\\documentclass[letterpaper]{article}\n\\usepackage{pdfpages}\n\\begin{document}\n')
+            for pdf_path in pdf_paths:
+                f.write(f'\\includepdf[pages=-]{{{os.path.abspath(pdf_path)}}}\n')
+            f.write('\\end{document}\n')
+
+        with lsprofile.stage('merge_pdfs', rows=len(pdf_paths)):
+            returncode, _ = compile_tex(f'{tmpdir}/merged.tex', tmpdir)
+        if returncode != 0:
+            raise RuntimeError(f'pdflatex exited with code {returncode} while merging report shards')
+
+        shutil.move(f'{tmpdir}/merged.pdf', output_path)
+
+
+def build_per_student(student_progress: pd.DataFrame, template: list, header: str, args: argparse.Namespace,
+                      fmt: Optional[str] = None, fmt_key: str = ''):
+    '''
+    Build one report PDF per student and concatenate them into the combined PDF for Gradescope.
+
+    Each student's document is keyed by a hash of its LaTeX source and of the header format, which
+    covers their row of standards_achieved and both template files, so only new or changed reports
+    are recompiled.
+
+    :param student_progress: standards_achieved table with the _template row and student ids added
+    :param template: page template from compile_template
+    :param header: header to start each document with, without the preamble if fmt is given
+    :param args: command line arguments
+    :param fmt: precompiled header format from build_format, or None
+    :param fmt_key: hash the format is keyed by
+    '''
+    student_dir = f'{args.output_path}/ls_reports/students'
+    os.makedirs(student_dir, exist_ok=True)
+
+    manifest_path = f'{student_dir}/manifest.json'
+    try:
+        with open(manifest_path, 'r') as f:
+            manifest = json.load(f)
+    except (FileNotFoundError, ValueError):
+        manifest = {}
+
+    # write out the documents that changed since they were last compiled
+    with lsprofile.stage('build_tex', rows=len(student_progress)):
+        todo = []
+        for name, page in zip(student_progress.index, build_pages(student_progress, template)):
+            tex = header + page + "\n\\end{document}"
+            key = hashlib.sha256((fmt_key + tex).encode()).hexdigest()
+
+            if manifest.get(name) == key and os.path.exists(f'{student_dir}/{name}.pdf'):
+                continue
+
+            with open(f'{student_dir}/{name}.tex', 'w') as f:
+                f.write(tex)
+            todo.append((name, key))
+
+    print(f'Compiling {len(todo)} of {len(student_progress)} reports')
+
+    from tqdm import tqdm
+
+    t1 = datetime.datetime.now()
+    with ThreadPool(max(1, mp.cpu_count())) as p:
+        results = list(tqdm(p.imap(lambda x: compile_tex(f'{student_dir}/{x[0]}.tex', student_dir, fmt), todo),
+                            desc='Compiling reports',
+                            total=len(todo)))
+
+    # record successful builds even if others failed, so they are not rebuilt next time
+    failed = []
+    for (name, key), (returncode, _) in zip(todo, results):
+        if returncode != 0:
+            failed.append(name)
+            manifest.pop(name, None)
+            continue
+
+        manifest[name] = key
+        for ext in ('aux', 'log', 'out'):
+            if os.path.exists(f'{student_dir}/{name}.{ext}'):
+                os.remove(f'{student_dir}/{name}.{ext}')
+
+    with open(manifest_path + '.tmp', 'w') as f:
+        json.dump(manifest, f)
+    os.replace(manifest_path + '.tmp', manifest_path)
+
+    if failed:
+        raise RuntimeError(f'pdflatex failed for {", ".join(failed)}, see the logs in {student_dir}')
+
+    merge_pdfs([f'{student_dir}/{name}.pdf' for name in student_progress.index],
+               f'{args.output_path}/ls_reports/pdf/combined.pdf')
+
+    print(f'Built PDF in {(datetime.datetime.now() - t1).total_seconds()} s.')
+
 
 def run(args: argparse.Namespace):
-    student_progress = pd.read_csv(f'{args.output_path}/standards_achieved.csv',
-                                   header=[0, 1],
-                                   index_col=0)
+    with lsprofile.stage('read_standards_achieved'):
+        if args.db:
+            student_progress = lsdb.read_achieved(args.db)
+        else:
+            student_progress = lsoutput.read_achieved(args.output_path, args.output_format)
 
 
-    roster = pd.read_csv(f'{args.data_path}/mat188-2023f-roster.csv',
-                        index_col=3)['Student Number']
+    roster = pd.concat([pd.read_csv(f'{args.data_path}/{x}-roster.csv', index_col=3)
+                        for x in args.course_prefix])['Student Number']
+    # students on more than one roster keep the entry of the last prefix, as in lsa_v4.read_course_csv
+    roster = roster[~roster.index.duplicated(keep='last')]
     student_progress[('student',
                     'student_id')] = [roster[x] for x in student_progress.index]
 
@@ -81,47 +302,103 @@ def run(args: argparse.Namespace):
                 ('student', 'student_id')]] = ' '
     student_progress = pd.concat([templaterow, student_progress])
 
-    # write header
-    if os.path.exists(f'{args.output_path}/ls_reports/tex/combined.tex'):
-        os.remove(f'{args.output_path}/ls_reports/tex/combined.tex')
-
-    shutil.copy('./tex_files/ls_report_header.tex', f'{args.output_path}/ls_reports/tex/combined.tex')
-
     # for testing, only build first 20 students
     if args.debug:
         student_progress = student_progress.iloc[::len(student_progress) // 20]
 
-    for ri, row in tqdm(student_progress.iterrows(),
-                        desc='Building reports',
-                        total=len(student_progress)):
-        filename = ri
+    template = compile_template('./tex_files/ls_report_page.tex')
+    with open('./tex_files/ls_report_header.tex', 'r') as f:
+        header = f.read()
+
+    # the preamble is loaded from a precompiled format instead of being processed for every document
+    fmt, fmt_key = None, ''
+    if not args.no_format:
+        fmt, fmt_key = build_format(header, f'{args.output_path}/ls_reports/fmt')
+        if fmt is not None:
+            header = header[header.index('\\begin{document}'):]
+
+    if args.per_student:
+        build_per_student(student_progress, template, header, args, fmt, fmt_key)
+        return
+
+    # split reports into contiguous shards, keeping roster order
+    tex_dir = f'{args.output_path}/ls_reports/tex'
+    n_shards = max(1, min(args.shards, len(student_progress)))
+    shard_rows = np.array_split(np.arange(len(student_progress)), n_shards)
+    if n_shards == 1:
+        shard_names = ['combined']
+    else:
+        shard_names = [f'combined_{si:03d}' for si in range(n_shards)]
+
+    from tqdm import tqdm
+
+    # remove shards of earlier runs with a different number of shards
+    for x in os.listdir(tex_dir):
+        if re.fullmatch(r'combined(_\d+)?\.tex', x) and x[:-len('.tex')] not in shard_names:
+            os.remove(f'{tex_dir}/{x}')
+
+    for name, rows in zip(shard_names, shard_rows):
+        # stream header, pages and end of document through a single writer
+        with lsprofile.stage('build_tex', file=f'{name}.tex', rows=len(rows)), \
+                open(f'{tex_dir}/{name}.tex', 'w', buffering=1 << 20) as f:
+            f.write(header)
+
+            for page in tqdm(build_pages(student_progress.iloc[rows], template),
+                             desc=f'Building reports ({name})',
+                             total=len(rows)):
+                f.write(page)
+
+            f.write("\n\\end{document}")
+
+    # compile each shard in its own directory, in parallel
+    t1 = datetime.datetime.now()
+    failed_dir = f'{args.output_path}/ls_reports/failed'
+    shutil.rmtree(failed_dir, ignore_errors=True)
+    shard_dirs = [tempfile.mkdtemp(prefix=f'{name}_', dir=f'{args.output_path}/ls_reports') for name in shard_names]
+    try:
+        with ThreadPool(min(n_shards, max(1, mp.cpu_count()))) as p:
+            results = p.starmap(compile_tex, [(f'{tex_dir}/{name}.tex', shard_dir, fmt)
+                                              for name, shard_dir in zip(shard_names, shard_dirs)])
+
+        for name, rows, (returncode, seconds) in zip(shard_names, shard_rows, results):
+            print(f'  {name}: {len(rows)} reports in {seconds:.1f} s (pdflatex exit code {returncode})')
+
+        # only the directories of failed shards are kept, with their logs
+        failed = [(name, shard_dir) for name, shard_dir, (returncode, _) in zip(shard_names, shard_dirs, results)
+                  if returncode != 0]
+        if failed:
+            os.makedirs(failed_dir)
+            for name, shard_dir in failed:
+                shutil.move(shard_dir, f'{failed_dir}/{name}')
+            raise RuntimeError(f'pdflatex failed for {", ".join(name for name, _ in failed)}, see the logs in {failed_dir}')
+
+        shard_pdfs = [f'{shard_dir}/{name}.pdf' for name, shard_dir in zip(shard_names, shard_dirs)]
+        if n_shards == 1:
+            shutil.move(shard_pdfs[0], f'{args.output_path}/ls_reports/pdf/combined.pdf')
+        else:
+            merge_pdfs(shard_pdfs, f'{args.output_path}/ls_reports/pdf/combined.pdf')
+    finally:
+        # remove everything that doesn't end with pdf
+        for shard_dir in shard_dirs:
+            shutil.rmtree(shard_dir, ignore_errors=True)
 
-        build_tex(row, args, filename=filename)
+    print(f'Built PDF in {(datetime.datetime.now() - t1).total_seconds()} s.')
 
-    # end document
-    with open(f"{args.output_path}/ls_reports/tex/combined.tex", "a") as f:
-        f.write("\n\\end{document}")
 
-    # compile
-    t1 = datetime.datetime.now()
-    subprocess.run(['pdflatex', '-output-directory', f'{args.output_path}/ls_reports/pdf', f'{args.output_path}/ls_reports/tex/combined.tex'])
+def main(args: argparse.Namespace):
+    ''' Build the reports with the options from lscli.add_report_arguments '''
+    if args.profile:
+        lsprofile.enable(f'{args.output_path}/profile' if args.cprofile else None)
 
-    # remove everything that doesn't end with pdf            
-    os.remove(f'{args.output_path}/ls_reports/pdf/combined.aux')
-    os.remove(f'{args.output_path}/ls_reports/pdf/combined.log')
-    os.remove(f'{args.output_path}/ls_reports/pdf/combined.out')
+    run(args)
 
-    print(f'Built PDF in {(datetime.datetime.now() - t1).total_seconds()} s.')
+    if args.profile:
+        print(lsprofile.summary())
+        lsprofile.write_trace(f'{args.output_path}/profile/report_trace.json')
 
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(
         description='Build learning standard reports.')
-    parser.add_argument(
-        '--debug',
-        action='store_true',
-        help='Run in debug mode, only generate 20 reports for testing.')
-    args = parser.parse_args()
-
-    run(args)
-    
\ No newline at end of file
+    lscli.add_report_arguments(parser)
+    main(parser.parse_args())
@@ -0,0 +1,187 @@
+# # Compact score store
+#
+# MAT188 2023F at the University of Toronto
+
+# %%
+from typing import Optional
+
+import numpy as np
+import pandas as pd
+
+try:
+    import resource
+except ImportError:  # not available on Windows
+    resource = None
+
+# encoding of ScoreStore.correct
+CORRECT = 1  # the score value is truthy
+INCORRECT = 0  # the score value is falsy
+UNTESTED = -1  # no score value
+
+# encoding of ScoreStore.graded
+GRADED = 1  # is_graded is set and not False
+UNGRADED = 0  # is_graded == False
+UNSPECIFIED = -1  # the source has no is_graded value for this row
+
+
+def _truthy(values: np.ndarray, is_na: np.ndarray) -> np.ndarray:
+    ''' Python truthiness of each value, treating missing values as False '''
+    if values.dtype.kind in 'biuf':
+        return np.where(is_na, False, values).astype(bool)
+
+    values = values.astype(object)
+    values[is_na] = False
+    return values.astype(bool)
+
+
+class ScoreStore:
+    '''
+    Long-format score table held as integer-coded NumPy columns.
+
+    Students and questions are stored once in append-only dictionaries (``students`` and
+    ``questions``); each score row refers to them by int32 code. ``correct`` and ``graded`` are int8
+    with the encodings defined at the top of this module. WeBWorK rows also keep their ``score``
+    (float32, NaN elsewhere) and ``n_incor`` (int16, -1 elsewhere).
+    '''
+
+    FIELDS = ('stu', 'q', 'correct', 'graded', 'score', 'n_incor')
+
+    def __init__(self):
+        self._student_codes = {}
+        self._question_codes = {}
+        self._chunks = {x: [] for x in self.FIELDS}
+        self._arrays = None
+
+    @classmethod
+    def from_frame(cls, scores: pd.DataFrame) -> 'ScoreStore':
+        store = cls()
+        store.append(scores)
+        return store
+
+    @staticmethod
+    def _encode(codes: dict, values: pd.Series) -> np.ndarray:
+        ''' Code each value, adding new values to the dictionary '''
+        row_codes, uniques = pd.factorize(values, use_na_sentinel=True)
+        lut = np.array([codes.setdefault(x, len(codes)) for x in uniques], dtype=np.int32)
+        return lut[row_codes]
+
+    def append(self, frame: pd.DataFrame):
+        '''
+        Add score rows. Rows without a login name or score key are dropped.
+
+        :param frame: long-format scores with columns ['login_name', 'score_key', 'correct'] and optionally 'is_graded', 'score' and 'n_incor'
+        '''
+        login_name = frame['login_name']
+        frame = frame[login_name.notna() & (login_name != '') & frame['score_key'].notna()]
+
+        correct = frame['correct'].to_numpy()
+        correct_na = np.asarray(pd.isna(correct), dtype=bool)
+        correct = np.where(correct_na, UNTESTED, _truthy(correct, correct_na)).astype(np.int8)
+
+        graded = np.full(len(frame), UNSPECIFIED, dtype=np.int8)
+        if 'is_graded' in frame.columns:
+            graded[frame['is_graded'].notna().to_numpy()] = GRADED
+            graded[(frame['is_graded'] == False).to_numpy(dtype=bool)] = UNGRADED
+
+        score = np.full(len(frame), np.nan, dtype=np.float32)
+        if 'score' in frame.columns:
+            score[:] = pd.to_numeric(frame['score'], errors='coerce').to_numpy(dtype=np.float32)
+
+        n_incor = np.full(len(frame), -1, dtype=np.int16)
+        if 'n_incor' in frame.columns:
+            n_incor[:] = pd.to_numeric(frame['n_incor'], errors='coerce').fillna(-1).to_numpy(dtype=np.int16)
+
+        self._chunks['stu'].append(self._encode(self._student_codes, frame['login_name']))
+        self._chunks['q'].append(self._encode(self._question_codes, frame['score_key']))
+        self._chunks['correct'].append(correct)
+        self._chunks['graded'].append(graded)
+        self._chunks['score'].append(score)
+        self._chunks['n_incor'].append(n_incor)
+        self._arrays = None
+
+    def _column(self, field: str) -> np.ndarray:
+        if self._arrays is None:
+            # consolidate appended chunks into contiguous arrays
+            dtypes = {'stu': np.int32, 'q': np.int32, 'correct': np.int8, 'graded': np.int8,
+                      'score': np.float32, 'n_incor': np.int16}
+            self._arrays = {x: np.concatenate(self._chunks[x]) if self._chunks[x] else np.zeros(0, dtype=dtypes[x])
+                            for x in self.FIELDS}
+            self._chunks = {x: [self._arrays[x]] for x in self.FIELDS}
+
+        return self._arrays[field]
+
+    stu = property(lambda self: self._column('stu'))
+    q = property(lambda self: self._column('q'))
+    correct = property(lambda self: self._column('correct'))
+    graded = property(lambda self: self._column('graded'))
+    score = property(lambda self: self._column('score'))
+    n_incor = property(lambda self: self._column('n_incor'))
+
+    @property
+    def students(self) -> pd.Index:
+        ''' Login name of each student code '''
+        return pd.Index(list(self._student_codes), dtype=object)
+
+    @property
+    def questions(self) -> pd.Index:
+        ''' Score key of each question code '''
+        return pd.Index(list(self._question_codes), dtype=object)
+
+    def __len__(self):
+        return len(self.stu)
+
+    @property
+    def nbytes(self) -> int:
+        return sum(self._column(x).nbytes for x in self.FIELDS)
+
+    def take(self, rows: np.ndarray) -> 'ScoreStore':
+        '''
+        Copy of some rows, sharing this store's dictionaries so that the codes keep their meaning.
+
+        Nothing should be appended to the copy, as that would also add to this store's dictionaries.
+
+        :param rows: row positions
+        :return: ScoreStore
+        '''
+        store = ScoreStore()
+        store._student_codes = self._student_codes
+        store._question_codes = self._question_codes
+        store._arrays = {x: self._column(x)[rows] for x in self.FIELDS}
+        store._chunks = {x: [store._arrays[x]] for x in self.FIELDS}
+        return store
+
+    def _decode(self, rows: slice) -> pd.DataFrame:
+        return pd.DataFrame({
+            'login_name': pd.Categorical.from_codes(self.stu[rows], categories=self.students),
+            'score_key': pd.Categorical.from_codes(self.q[rows], categories=self.questions),
+            'correct': np.where(self.correct[rows] == UNTESTED, np.nan, self.correct[rows]),
+            'is_graded': pd.array(np.where(self.graded[rows] == UNSPECIFIED, None, self.graded[rows] == GRADED),
+                                  dtype='boolean'),
+            'score': self.score[rows],
+            'n_incor': pd.array(np.where(self.n_incor[rows] < 0, None, self.n_incor[rows]), dtype='Int16'),
+        }, index=pd.RangeIndex(rows.start, rows.stop))
+
+    def to_frame(self) -> pd.DataFrame:
+        ''' Decode into a DataFrame with categorical login_name and score_key columns '''
+        return self._decode(slice(0, len(self)))
+
+    def iter_frames(self, chunk_rows: int = 1 << 20):
+        ''' Decode chunk_rows rows at a time, as for to_frame '''
+        for lo in range(0, len(self), chunk_rows):
+            yield self._decode(slice(lo, min(lo + chunk_rows, len(self))))
+
+
+def memory_report(store: Optional[ScoreStore] = None) -> str:
+    ''' One-line summary of the process' memory use and, optionally, of a score store '''
+    import psutil
+
+    parts = []
+    if store is not None:
+        parts.append(f'score store {len(store)} rows in {store.nbytes / 2**20:.1f} MB')
+
+    parts.append(f'RSS {psutil.Process().memory_info().rss / 2**20:.0f} MB')
+    if resource is not None:
+        # ru_maxrss is in KiB on Linux
+        parts.append(f'peak RSS {resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 2**10:.0f} MB')
+
+    return 'Memory: ' + ', '.join(parts)
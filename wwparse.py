@@ -7,8 +7,8 @@
 # %%
 # Imports
 import pandas as pd
-from bs4 import BeautifulSoup
 import re
+from html.parser import HTMLParser
 import os.path
 import numpy as np
 
@@ -16,16 +16,78 @@ import numpy as np
 # ### Parse HTML to get table
 
 
-def parse_html(filename: str, save_csv: bool = True, stacked: bool = True):
+def parse_html(filename: str, save_csv: bool = True, stacked: bool = True, engine: str = 'bs4'):
     '''
     Parse HTML file exported from the WeBWorK student progress screen to get student scores.
 
     :param filename: path to HTML file
     :param save_csv: whether to save the parsed DataFrame as a CSV file
     :param stacked: whether to return a stacked DataFrame (one row per problem) or a wide DataFrame (one row per student, as per the HTML file)
+    :param engine: 'bs4' to build a full BeautifulSoup tree, or 'stream' to tokenize the progress table incrementally (faster on large exports)
     :return: DataFrame with columns ['login_name', 'problem_num', 'score', 'n_incor', 'webwork_set']
     '''
 
+    if engine == 'bs4':
+        df = _parse_progress_bs4(filename)
+    elif engine == 'stream':
+        df = _parse_progress_stream(filename)
+    else:
+        raise ValueError(f'Unknown WeBWorK parser engine: {engine}')
+
+    if stacked:
+        # add webwork number
+        # e.g. mat188-2023f-ww3.html, with any course prefix
+        fname_re = re.search(r'\-([a-z]{2}\d+)r?\.html$', os.path.basename(filename))
+        if fname_re is None:
+            raise ValueError(f'Cannot tell the set from the file name: {filename}')
+        final_df = stack_problems(df, fname_re.group(1))
+
+    else:
+        final_df = df
+
+    if save_csv:
+        final_df.to_csv(os.path.splitext(filename)[0] + '_scores.csv',
+                        index=False)
+
+    return final_df
+
+
+def stack_problems(df: pd.DataFrame, set_id: str) -> pd.DataFrame:
+    '''
+    Reshape a wide progress table (one row per student) into one row per student and problem.
+
+    :param df: wide DataFrame from parse_html(..., stacked=False)
+    :param set_id: WeBWorK set identifier, e.g. 'ww3'
+    :return: DataFrame with columns ['login_name', 'score', 'n_incor', 'problem_num', 'set_id', 'score_key'], grouped by problem
+    '''
+
+    # get problem indices
+    prob_cols = [col for col in df.columns if 'problem' in col]
+    problems = sorted(set(int(re.match(r'problem(\d+)+_', col).group(1)) for col in prob_cols))
+    fields = list(dict.fromkeys(re.sub(r'^problem\d+_', '', col) for col in prob_cols))
+
+    n_rows, n_probs = len(df), len(problems)
+    final_df = {'login_name': np.tile(df['login_name'].to_numpy(), n_probs)}
+
+    # stack each field as a (problem x student) block, filling in problems without that field
+    for field in fields:
+        cols = [f'problem{prob}_{field}' for prob in problems]
+        if all(col in df.columns for col in cols):
+            final_df[field] = df[cols].to_numpy().T.ravel()
+        else:
+            final_df[field] = df.reindex(columns=cols).to_numpy(dtype=float).T.ravel()
+
+    final_df['problem_num'] = np.repeat(np.array(problems, dtype=np.int64), n_rows)
+    final_df['set_id'] = pd.Categorical.from_codes(np.zeros(n_rows * n_probs, dtype=np.int8), categories=[set_id])
+    final_df['score_key'] = np.repeat(np.array([f'{set_id}-{prob}' for prob in problems], dtype=object), n_rows)
+
+    return pd.DataFrame(final_df)
+
+
+def _parse_progress_bs4(filename: str) -> pd.DataFrame:
+    ''' Parse the progress table into a wide DataFrame (one row per student) using BeautifulSoup '''
+    from bs4 import BeautifulSoup  # imported here as only this engine needs it
+
     # read student progress export
     with open(filename, "r", encoding="utf-8") as file:
         content = file.read()
@@ -107,46 +169,149 @@ def parse_html(filename: str, save_csv: bool = True, stacked: bool = True):
     df = df[['login_name', 'total_score', 'total_outof'] +
             [col for col in df.columns if 'problem' in col]]
 
-    if stacked:
-        # get problem indices
-        problems = list(
-            set([
-                int(re.match(r'problem(\d+)+_', col).group(1))
-                for col in df.columns if 'problem' in col
-            ]))
-
-        all_data = []
-
-        for prob in problems:
-            col_names = [x for x in df.columns if f'problem{prob}_' in x]
-            col_names.insert(0, 'login_name')
-
-            col_names_clean = [
-                x.replace(f'problem{prob}_', '') for x in col_names
-            ]
-
-            sub_df = df[col_names].copy()
-            sub_df.columns = col_names_clean
-
-            sub_df['problem_num'] = prob
-            all_data.append(sub_df)
+    return df
+
+
+class _ProgressTableParser(HTMLParser):
+    ''' Incrementally collect the text of each cell of the first table, calling on_row for every row '''
+
+    def __init__(self, on_row):
+        super().__init__(convert_charrefs=True)
+        self.on_row = on_row
+        self.table_depth = 0
+        self.done = False
+        self.row = None
+        self.cell = None
+
+    def handle_starttag(self, tag, attrs):
+        if self.done:
+            return
+
+        if tag == 'table':
+            self.table_depth += 1
+        elif self.table_depth == 0:
+            return
+        elif tag == 'tr':
+            self.row = []
+        elif tag == 'td' and self.row is not None:
+            self.cell = []
+
+    def handle_endtag(self, tag):
+        if self.done or self.table_depth == 0:
+            return
+
+        if tag == 'td' and self.cell is not None:
+            self.row.append(''.join(self.cell))
+            self.cell = None
+        elif tag == 'tr' and self.row is not None:
+            self.on_row(self.row)
+            self.row = None
+        elif tag == 'table':
+            self.table_depth -= 1
+            self.done = self.table_depth == 0
+
+    def handle_data(self, data):
+        if self.cell is not None:
+            self.cell.append(data)
+
+
+def _parse_progress_stream(filename: str, chunk_size: int = 1 << 16) -> pd.DataFrame:
+    ''' Parse the progress table into a wide DataFrame (one row per student) with a streaming tokenizer '''
+
+    state = {}
+    login_name = []
+    capacity = 256
+    totals = np.full((capacity, 2), np.nan)  # total_score, total_outof
+    problem_scores = None
+    problem_n_incor = None
+
+    def read_header(headers):
+        state['problem_scores_col'] = np.where(['Problems' in x for x in headers])[0][0]
+        state['score_col'] = np.where(['Score' in x for x in headers])[0][0]
+        state['total_col'] = np.where(['Out Of' in x for x in headers])[0][0]
+        state['n_problems'] = len(headers[state['problem_scores_col']].split())
+        state['has_score'] = np.zeros(state['n_problems'], dtype=bool)
+        state['has_n_incor'] = np.zeros(state['n_problems'], dtype=bool)
+
+    def read_row(rowtd):
+        nonlocal capacity, totals, problem_scores, problem_n_incor
+
+        if not state:
+            read_header(rowtd)
+            n_problems = state['n_problems']
+            problem_scores = np.full((capacity, n_problems), np.nan)
+            problem_n_incor = np.full((capacity, n_problems), np.nan)
+            return
+
+        # grow preallocated arrays geometrically as rows arrive
+        r = len(login_name)
+        if r == capacity:
+            capacity *= 2
+            totals = np.resize(totals, (capacity, 2))
+            problem_scores = np.resize(problem_scores, (capacity, state['n_problems']))
+            problem_n_incor = np.resize(problem_n_incor, (capacity, state['n_problems']))
+
+        totals[r] = np.nan
+        problem_scores[r] = np.nan
+        problem_n_incor[r] = np.nan
+        login_name.append(np.nan)
+
+        n_problems = state['n_problems']
+        try:
+            login_name[r] = rowtd[-1]
 
-        final_df = pd.concat(all_data).reset_index(drop=True)
-        # final_df = final_df[['login_name', 'problem_num', 'score', 'n_incor']]
+            # Extracting total scores
+            totals[r, 0] = float(rowtd[state['score_col']])
 
-        # add webwork number
-        fname_re = re.search(r'mat188\-2023f\-([a-z]{2}\d+)r?\.html',
-                                       filename)
-        final_df['set_id'] = fname_re.group(1)
+            if rowtd[state['total_col']].isdigit():
+                totals[r, 1] = float(rowtd[state['total_col']])
+            else:
+                # unscored rows are kept as empty rows, as with the bs4 engine
+                login_name[r] = np.nan
+                totals[r] = np.nan
+                return
 
-        final_df['score_key'] = final_df.apply(
-            lambda r: f'{r["set_id"]}-{r["problem_num"]:.0f}', axis=1)
+            # Extracting problem scores and attempts
+            problems_data = rowtd[state['problem_scores_col']].split()
+            for i in range(n_problems):
+                score = problems_data[i]
+                # Setting score to 0 if it's not a valid number
+                if not score.replace('.', '', 1).isdigit():
+                    score = np.nan
+                problem_scores[r, i] = float(score)
+                state['has_score'][i] = True
 
-    else:
-        final_df = df
+                # check if there's a number of incorrect attempts
+                if len(problems_data) > n_problems:
+                    problem_n_incor[r, i] = int(problems_data[i + n_problems])
+                    state['has_n_incor'][i] = True
 
-    if save_csv:
-        final_df.to_csv(os.path.splitext(filename)[0] + '_scores.csv',
-                        index=False)
+        except Exception as e:
+            print('Error parsing row:')
+            print(e)
+            print(rowtd)
 
-    return final_df
+    parser = _ProgressTableParser(read_row)
+    with open(filename, "r", encoding="utf-8") as file:
+        while not parser.done:
+            chunk = file.read(chunk_size)
+            if not chunk:
+                break
+            parser.feed(chunk)
+    parser.close()
+
+    n_rows = len(login_name)
+    data = {
+        'login_name': np.array(login_name, dtype=object),
+        'total_score': totals[:n_rows, 0],
+        'total_outof': totals[:n_rows, 1],
+    }
+    for i in range(state['n_problems']):
+        if state['has_score'][i]:
+            data[f'problem{i+1}_score'] = problem_scores[:n_rows, i]
+
+        if state['has_n_incor'][i]:
+            n_incor = problem_n_incor[:n_rows, i]
+            data[f'problem{i+1}_n_incor'] = n_incor if np.isnan(n_incor).any() else n_incor.astype(np.int64)
+
+    return pd.DataFrame(data)
@@ -0,0 +1,125 @@
+# # Workbook parser
+#
+# MAT188 2023F at the University of Toronto
+#
+# Streams the tutorial SBG workbooks and the manual score workbook straight into long-format score
+# records, reading only the cell values of the columns that are used.
+
+# %%
+import re
+
+import numpy as np
+import pandas as pd
+
+# score keys of tutorial questions, e.g. tut3-2-b for week 3, SBG 2, part b
+SBG_KEY_RE = re.compile(r'.*\d+\-(\d+)\-\w+')
+
+RECORD_COLUMNS = ['login_name', 'score_key', 'correct']
+
+# columns of the manual score workbook: the record columns and the optional ones kept by scorestore.ScoreStore
+MANUAL_COLUMNS = RECORD_COLUMNS + ['is_graded', 'score', 'n_incor']
+
+
+def iter_sheet_rows(filename: str):
+    '''
+    Cell values of the first worksheet of a workbook, one tuple per row, without loading the workbook.
+
+    The workbook is opened in read-only mode, so rows are parsed as they are iterated and styles are skipped.
+
+    :param filename: path to .xlsx file
+    :return: generator of row tuples, the first being the header row; empty cells are None
+    '''
+    from openpyxl import load_workbook
+
+    wb = load_workbook(filename, read_only=True, data_only=True)
+    try:
+        yield from wb.worksheets[0].iter_rows(values_only=True)
+    finally:
+        wb.close()
+
+
+def _cell(row: tuple, ci: int):
+    ''' Value of column ci, with empty cells as NaN as read by pd.read_excel '''
+    value = row[ci] if ci < len(row) else None
+    return np.nan if value is None or value == '' else value
+
+
+def iter_sbg_records(filename: str, email_login: dict):
+    '''
+    Long-format score records of a tutorial SBG workbook.
+
+    Only the name and Email columns and the score columns, whose header is '<description> | <score key>',
+    are read. Sum rows at the bottom (no first or last name) and students whose Email is not in
+    email_login are skipped.
+
+    :param filename: path to *_SBG.xlsx file
+    :param email_login: dict of Email -> login name, e.g. from the roster
+    :return: generator of (login_name, score_key, correct) tuples
+    '''
+    rows = iter_sheet_rows(filename)
+    header = next(rows, None)
+    if header is None:
+        return
+
+    header = [x if isinstance(x, str) else '' for x in header]
+    first_col, last_col, email_col = (header.index(x) for x in ('First Name', 'Last Name', 'Email'))
+    score_cols = [(ci, x.split('|')[1].strip()) for ci, x in enumerate(header) if '|' in x]
+
+    # every score key must name its SBG, as tutorial grading looks it up
+    for _, key in score_cols:
+        if SBG_KEY_RE.search(key) is None:
+            raise ValueError(f'Tutorial score key without an SBG number in {filename}: {key}')
+
+    for row in rows:
+        if _cell(row, first_col) is np.nan and _cell(row, last_col) is np.nan:
+            continue
+
+        login_name = email_login.get(_cell(row, email_col))
+        if login_name is None or login_name == '':
+            continue
+
+        for ci, key in score_cols:
+            yield login_name, key, _cell(row, ci)
+
+
+def iter_manual_records(filename: str):
+    '''
+    Score records of the manual score workbook, with columns login_name, score_key and correct and
+    optionally is_graded, score and n_incor. Empty rows are skipped.
+
+    :param filename: path to manual scores .xlsx file
+    :return: generator of tuples of the MANUAL_COLUMNS, with NaN for optional columns the workbook does not have
+    '''
+    rows = iter_sheet_rows(filename)
+    header = next(rows, None)
+    if header is None:
+        return
+
+    header = list(header)
+    missing = [x for x in RECORD_COLUMNS if x not in header]
+    if missing:
+        raise ValueError(f'Columns missing from {filename}: {missing}')
+
+    # a column that is not used would silently change nothing, e.g. a misspelt is_graded
+    unknown = [x for x in header if x not in MANUAL_COLUMNS and x not in (None, '')]
+    if unknown:
+        raise ValueError(f'Unsupported columns in {filename}: {unknown} (supported: {MANUAL_COLUMNS})')
+    cols = [header.index(x) if x in header else None for x in MANUAL_COLUMNS]
+
+    for row in rows:
+        values = tuple(np.nan if ci is None else _cell(row, ci) for ci in cols)
+        if not all(x is np.nan for x in values):
+            yield values
+
+
+def records_frame(records, columns: list = RECORD_COLUMNS) -> pd.DataFrame:
+    '''
+    DataFrame of score records.
+
+    :param records: iterable of tuples of columns
+    :param columns: column names, starting with login_name, score_key and correct
+    :return: DataFrame with the given columns
+    '''
+    df = pd.DataFrame.from_records(list(records), columns=columns)
+    df['correct'] = df['correct'].infer_objects()
+    return df